@@ -0,0 +1,135 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+CACHE_MEMORY_ITEMS = int(os.getenv('AI_CACHE_MEMORY_ITEMS', 1000))
+CACHE_TTL = float(os.getenv('AI_CACHE_TTL', 7 * 24 * 60 * 60))
+# Пустой путь - только память
+CACHE_DISK_DIR = os.getenv('AI_CACHE_DISK_DIR', '')
+CACHE_DISK_MAX_BYTES = int(os.getenv('AI_CACHE_DISK_MAX_BYTES', 200 * 1024 * 1024))
+# Списывать ли токены за ответ из кэша
+CACHE_BILL_HITS = os.getenv('AI_CACHE_BILL_HITS', '1') == '1'
+
+
+def cache_key(prompt: str | None, image: str | None = None) -> str:
+    # Ключ: нормализованный запрос + sha256 картинки
+    normalized = re.sub(r'\s+', ' ', (prompt or '').strip().lower())
+    image_hash = hashlib.sha256(base64.b64decode(image)).hexdigest() if image else ''
+    return hashlib.sha256(f'{normalized}\n{image_hash}'.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    # LRU в памяти + необязательный кэш на диске с TTL и ограничением по размеру
+    def __init__(self, name: str, max_items: int = CACHE_MEMORY_ITEMS, ttl: float = CACHE_TTL,
+                 disk_dir: str = CACHE_DISK_DIR, disk_max_bytes: int = CACHE_DISK_MAX_BYTES):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.disk_dir = os.path.join(disk_dir, name) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_bytes = None
+        self.memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f'{key}.json')
+
+    def _disk_get(self, key: str) -> str | None:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)['value']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _disk_files(self) -> list[tuple[float, int, str]]:
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _disk_put(self, key: str, value: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({'value': value}, ensure_ascii=False).encode('utf-8')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(size for _, size, _ in self._disk_files())
+        else:
+            self.disk_bytes += len(data)
+
+        if self.disk_bytes > self.disk_max_bytes:
+            # удаляем самые старые файлы, пока не уложимся в 90% лимита
+            files = sorted(self._disk_files())
+            self.disk_bytes = sum(size for _, size, _ in files)
+            for _, size, old_path in files:
+                if self.disk_bytes <= self.disk_max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+                self.disk_bytes -= size
+
+    def _memory_put(self, key: str, value: str):
+        self.memory[key] = (time.monotonic() + self.ttl, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    async def get(self, key: str) -> str | None:
+        item = self.memory.get(key)
+        if item and item[0] > time.monotonic():
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        if item:
+            del self.memory[key]
+
+        if self.disk_dir:
+            value = await asyncio.to_thread(self._disk_get, key)
+            if value is not None:
+                self._memory_put(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, value: str):
+        self._memory_put(key, value)
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_put, key, value)
+            except OSError as e:
+                print(e)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'items': len(self.memory),
+        }
+
+
+receipt_cache = ResponseCache('receipt')
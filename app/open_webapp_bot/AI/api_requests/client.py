@@ -0,0 +1,67 @@
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+# resilience при импорте загружает .env, поэтому настройки ниже уже прочитаются из него
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry
+
+API = os.getenv('API_GPT')
+BASE_URL = os.getenv('AI_BASE_URL', 'https://openrouter.ai/api/v1')
+
+# Настройки пула соединений к OpenRouter
+MAX_CONNECTIONS = int(os.getenv('AI_MAX_CONNECTIONS', 200))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('AI_MAX_KEEPALIVE_CONNECTIONS', 50))
+KEEPALIVE_EXPIRY = float(os.getenv('AI_KEEPALIVE_EXPIRY', 30))
+CONNECT_TIMEOUT = float(os.getenv('AI_CONNECT_TIMEOUT', 10))
+READ_TIMEOUT = float(os.getenv('AI_READ_TIMEOUT', 600))
+
+_client: AsyncOpenAI | None = None
+
+
+def get_client() -> AsyncOpenAI:
+    # Один асинхронный клиент (и один пул httpx) на весь процесс
+    global _client
+    if _client is None:
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        )
+        _client = AsyncOpenAI(
+            base_url=BASE_URL,
+            api_key=API,
+            http_client=http_client,
+            # повторы делает call_with_retry
+            max_retries=0,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+async def stream_completion(model: str, messages: list, extra: dict | None = None):
+    # Отдаёт текст ответа по кускам по мере генерации (stream=True)
+    stream = await call_with_retry(model, lambda: get_client().chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True
+    ))
+    try:
+        async for chunk in stream:
+            if extra is not None and getattr(chunk, 'citations', None):
+                extra['citations'] = chunk.citations
+
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        # при aclose() генератора (отмена, отказ от ответа) HTTP-ответ закрывается сразу
+        await stream.close()
@@ -0,0 +1,102 @@
+import os
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.open_webapp_bot.AI.api_requests.client import get_client
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry
+from app.open_webapp_bot.AI.database.orm_query import orm_get_chat_summary, orm_set_chat_summary, \
+    orm_get_chat_history
+
+# Бюджет контекста (в токенах) для каждой истории
+CONTEXT_BUDGETS = {
+    'gpt': int(os.getenv('CONTEXT_BUDGET_GPT', 24000)),
+    'perplexity': int(os.getenv('CONTEXT_BUDGET_PERPLEXITY', 12000)),
+    'gemini': int(os.getenv('CONTEXT_BUDGET_GEMINI', 8000)),
+}
+CONTEXT_MAX_MESSAGES = int(os.getenv('CONTEXT_MAX_MESSAGES', 40))
+# После сворачивания окно ужимается до этой доли бюджета, чтобы пересчитывать резюме пореже
+CONTEXT_FOLD_RATIO = float(os.getenv('CONTEXT_FOLD_RATIO', 0.6))
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL', 'deepseek/deepseek-chat-v3.1:free')
+
+CHARS_PER_TOKEN = 3
+IMAGE_TOKENS = 1000
+
+
+def count_tokens(message: dict) -> int:
+    # Приблизительный подсчёт, без токенизатора конкретной модели
+    content = message['content']
+    if isinstance(content, str):
+        return len(content) // CHARS_PER_TOKEN + 4
+
+    tokens = 4
+    for part in content or []:
+        if part.get('type') == 'text':
+            tokens += len(part.get('text') or '') // CHARS_PER_TOKEN
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def message_text(message: dict) -> str:
+    content = message['content']
+    if isinstance(content, str):
+        return content
+    texts = [part.get('text') or '' for part in content or [] if part.get('type') == 'text']
+    if len(texts) < len(content or []):
+        texts.append('[изображение]')
+    return ' '.join(texts)
+
+
+async def summarize(summary: str, messages: list) -> str:
+    dialog = '\n'.join(f"{message['role']}: {message_text(message)}" for message in messages)
+    prompt = ('Сожми диалог пользователя с ассистентом в краткое резюме на языке диалога. '
+              'Сохрани факты, имена, договорённости и незакрытые вопросы, без вступлений.\n\n')
+    if summary:
+        prompt += f'Резюме предыдущей части:\n{summary}\n\n'
+    prompt += f'Новые сообщения:\n{dialog}'
+
+    response = await call_with_retry(SUMMARY_MODEL, lambda: get_client().chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[{"role": "user", "content": prompt}]
+    ), attempts=1)
+    return response.choices[0].message.content
+
+
+def fold_point(window: list, target: int) -> int:
+    # Первое сообщение, с которого хвост окна помещается в target, окно всегда начинается с user
+    tokens = 0
+    point = len(window) - 1
+    for i in range(len(window) - 1, -1, -1):
+        tokens += count_tokens(window[i])
+        if tokens > target or len(window) - i > CONTEXT_MAX_MESSAGES * CONTEXT_FOLD_RATIO:
+            break
+        point = i
+
+    while point < len(window) - 1 and window[point]['role'] != 'user':
+        point += 1
+    return point
+
+
+async def build_context(session: AsyncSession, user_id: int, model: str) -> list:
+    # История для запроса: резюме старой части + последние сообщения в пределах бюджета
+    budget = CONTEXT_BUDGETS.get(model, CONTEXT_BUDGETS['gpt'])
+    upto, summary = await orm_get_chat_summary(session, user_id, model)
+    window = await orm_get_chat_history(session, user_id, model, after=upto)
+
+    summary_tokens = len(summary or '') // CHARS_PER_TOKEN
+    if summary_tokens + sum(count_tokens(message) for message in window) > budget \
+            or len(window) > CONTEXT_MAX_MESSAGES:
+        point = fold_point(window, int(budget * CONTEXT_FOLD_RATIO))
+        if point > 0:
+            # окно ужимается только после сохранения резюме, иначе старая часть потеряется
+            try:
+                folded = await summarize(summary, window[:point])
+                await orm_set_chat_summary(session, user_id, model, upto + point, folded)
+                summary, window = folded, window[point:]
+            except Exception as e:
+                print(e)
+
+    if summary:
+        return [{"role": "system",
+                 "content": f'Краткое содержание предыдущей части диалога:\n{summary}'}] + window
+    return window
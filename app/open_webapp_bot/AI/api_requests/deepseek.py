@@ -1,20 +1,13 @@
-import asyncio
 import base64
-import os
 
-from openai import OpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.open_webapp_bot.AI.database.orm_query import orm_update_gpt_chat_history, orm_get_chat_history, \
+from app.open_webapp_bot.AI.database.orm_query import orm_update_gpt_chat_history, \
     orm_update_gemini_chat_history
-
-API = os.getenv('API_GPT')
-
-
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=API,
-)
+from app.open_webapp_bot.AI.api_requests.context import build_context
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry, to_ai_error
+from app.open_webapp_bot.AI.api_requests.client import get_client
+from app.open_webapp_bot.AI.api_requests.fallback import hedged, hedged_stream, CHAINS
 
 
 async def deepseek(session: AsyncSession, user_id: int, prompt: str = None,):
@@ -24,25 +17,44 @@ async def deepseek(session: AsyncSession, user_id: int, prompt: str = None,):
         "content": prompt},
     ], user_id)
 
-    history = await orm_get_chat_history(session, user_id, 'gemini')
-    print(history)
-    try:
+    history = await build_context(session, user_id, 'gemini')
+    response = await hedged('light_text', lambda model: call_with_retry(model, lambda: get_client().chat.completions.create(
+        model=model,
+        messages=history
+    )))
+
+    print(response)
+    ans = response.choices[0].message.content
+    await orm_update_gemini_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
+
+    return ans
 
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="deepseek/deepseek-chat-v3.1:free",
-            messages=history
-        )
 
-        print(response)
-        ans = response.choices[0].message.content
-        await orm_update_gemini_chat_history(session, [
-            {"role": "assistant", "content": ans}
-        ], user_id)
+async def deepseek_stream(session: AsyncSession, user_id: int, prompt: str = None,):
 
+    await orm_update_gemini_chat_history(session, [{
+        "role": "user",
+        "content": prompt},
+    ], user_id)
 
-        return ans
+    history = await build_context(session, user_id, 'gemini')
+
+    ans = ''
+    try:
+        async for delta in hedged_stream('light_text', history):
+            ans += delta
+            yield delta
 
     except Exception as e:
-        print(e)
-        return 'К сожалению, произошла ошибка. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+        # недописанный ответ всё равно сохраняем в историю
+        if ans:
+            await orm_update_gemini_chat_history(session, [
+                {"role": "assistant", "content": ans}
+            ], user_id)
+        raise to_ai_error(CHAINS['light_text'][0], e) from e
+
+    await orm_update_gemini_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
@@ -0,0 +1,113 @@
+import asyncio
+import os
+
+from app.open_webapp_bot.AI.api_requests.client import stream_completion
+from app.open_webapp_bot.AI.api_requests.resilience import AIRequestError
+
+
+def _chain(name: str, default: str) -> list[str]:
+    return [model.strip() for model in os.getenv(name, default).split(',') if model.strip()]
+
+
+# Цепочки моделей для режимов: первая основная, остальные запасные
+CHAINS = {
+    'light_text': _chain('AI_CHAIN_LIGHT_TEXT', 'deepseek/deepseek-chat-v3.1:free,deepseek/deepseek-chat-v3.1'),
+    'receipt': _chain('AI_CHAIN_RECEIPT', 'x-ai/grok-4-fast:free,x-ai/grok-4-fast'),
+    'image': _chain('AI_CHAIN_IMAGE', 'google/gemini-2.5-flash-image-preview'),
+}
+# Если основная модель не ответила за столько секунд, параллельно запускается следующая.
+# 0 - без параллельных запросов, следующая модель только после ошибки (картинки дорогие)
+HEDGE_DELAYS = {
+    'light_text': float(os.getenv('AI_HEDGE_LIGHT_TEXT', 8)),
+    'receipt': float(os.getenv('AI_HEDGE_RECEIPT', 10)),
+    'image': float(os.getenv('AI_HEDGE_IMAGE', 0)),
+}
+
+
+async def hedged(mode: str, request, discard=None):
+    # request(model) - корутина запроса к конкретной модели, discard(result) - закрыть лишний результат
+    models = CHAINS[mode]
+    delay = HEDGE_DELAYS.get(mode) or None
+    pending = set()
+    errors = []
+    launched = 0
+
+    def launch():
+        nonlocal launched
+        task = asyncio.create_task(request(models[launched]))
+        task.model = models[launched]
+        pending.add(task)
+        launched += 1
+
+    launch()
+    winner = None
+    try:
+        while pending:
+            timeout = delay if launched < len(models) else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                print(f'{mode}: {models[launched - 1]} не отвечает, запускаем {models[launched]}')
+                launch()
+                continue
+
+            moderation = None
+            for task in done:
+                pending.remove(task)
+                if task.exception() is not None:
+                    print(f'{mode}: {task.model} - {task.exception()}')
+                    if isinstance(task.exception(), AIRequestError) and task.exception().kind == 'moderation':
+                        moderation = task.exception()
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                elif discard:
+                    await discard(task.result())
+
+            if winner is not None:
+                return winner
+            if moderation is not None:
+                raise moderation
+            # запрос упал - сразу пробуем следующую модель
+            if launched < len(models):
+                launch()
+
+        raise errors[-1]
+    finally:
+        # проигравшие запросы отменяем и дожидаемся, а успевшие ответить закрываем через discard,
+        # иначе их соединения висят до сборки мусора
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        for task in pending:
+            if discard and not task.cancelled() and task.exception() is None:
+                try:
+                    await discard(task.result())
+                except Exception as e:
+                    print(e)
+
+
+async def hedged_stream(mode: str, messages: list):
+    # Для потокового ответа «первый байт» - первый кусок текста
+    async def open_stream(model: str):
+        stream = stream_completion(model, messages)
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            raise AIRequestError(model, 'empty')
+        except BaseException:
+            # в том числе отмена проигравшего запроса
+            await stream.aclose()
+            raise
+        return first, stream
+
+    async def close_stream(result):
+        await result[1].aclose()
+
+    first, stream = await hedged(mode, open_stream, close_stream)
+    try:
+        yield first
+        async for delta in stream:
+            yield delta
+    finally:
+        await stream.aclose()
@@ -1,18 +1,18 @@
-import asyncio
 import base64
-import os
 
-from openai import OpenAI
+from app.open_webapp_bot.AI.api_requests.cache import receipt_cache, cache_key
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry
+from app.open_webapp_bot.AI.api_requests.client import get_client
+from app.open_webapp_bot.AI.api_requests.fallback import hedged
 
 
-API = os.getenv('API_GPT')
+async def cached_receipt(prompt: str = None, image = None) -> str | None:
+    # готовый ответ из кэша, без запроса к модели (и без очереди ai_slot)
+    return await receipt_cache.get(cache_key(prompt, image))
 
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=API,
-)
 
-async def grok_for_receipt(prompt: str = None, image = None,):
+async def grok_for_receipt(prompt: str = None, image = None) -> str:
+    # запрос к модели, ответ сохраняется в кэш
     print('grok')
     if image and prompt:
         request = [{
@@ -40,22 +40,14 @@ async def grok_for_receipt(prompt: str = None, image = None,):
         ]
 
 
-    try:
+    response = await hedged('receipt', lambda model: call_with_retry(model, lambda: get_client().chat.completions.create(
+        model=model,
+        messages=request
+    )))
 
+    print(response)
+    ans = response.choices[0].message.content
+    if ans:
+        await receipt_cache.put(cache_key(prompt, image), ans)
 
-
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="x-ai/grok-4-fast:free",
-            messages=request
-        )
-
-        print(response)
-        ans = response.choices[0].message.content
-
-
-        return ans
-
-    except Exception as e:
-        print(e)
-        return 'К сожалению, произошла ошибка. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+    return ans
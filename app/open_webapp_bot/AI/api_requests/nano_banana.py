@@ -1,21 +1,11 @@
-import asyncio
 import base64
-import os
 
-from openai import OpenAI
-
-
-API = os.getenv('API_GPT')
-
-
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=API,
-)
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry, AIRequestError
+from app.open_webapp_bot.AI.api_requests.client import get_client
+from app.open_webapp_bot.AI.api_requests.fallback import hedged
 
 
 async def nano_banana(prompt: str, images: list = None,):
-    response = None
     if images:
 
         content = [
@@ -49,25 +39,19 @@ async def nano_banana(prompt: str, images: list = None,):
         ]
 
 
-    try:
-
-
-
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="google/gemini-2.5-flash-image-preview",
+    async def generate(model: str):
+        response = await call_with_retry(model, lambda: get_client().chat.completions.create(
+            model=model,
             messages=request
-        )
-
-
-        image_out = response.choices[0].message.images[0]['image_url']['url']
-        base64_str = image_out.split(",")[1]
-        image_bytes = base64.b64decode(base64_str)
-
-
-        return image_bytes
-
-    except Exception as e:
-        print(response)
-        print(e)
-        return 'К сожалению, произошла ошибка. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+        ))
+
+        try:
+            image_out = response.choices[0].message.images[0]['image_url']['url']
+            base64_str = image_out.split(",")[1]
+            return base64.b64decode(base64_str)
+        except Exception as e:
+            # модель ответила без картинки (чаще всего отказ по модерации)
+            print(response)
+            raise AIRequestError(model, 'empty', detail=repr(e)) from e
+
+    return await hedged('image', generate)
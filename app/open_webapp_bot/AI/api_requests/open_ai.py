@@ -1,23 +1,17 @@
-import asyncio
 import base64
-import os
 
-from openai import OpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.open_webapp_bot.AI.database.orm_query import orm_update_gpt_chat_history, orm_get_chat_history
+from app.open_webapp_bot.AI.database.orm_query import orm_save_image, orm_update_gpt_chat_history
+from app.open_webapp_bot.AI.database.blob_store import expand_image_refs
+from app.open_webapp_bot.AI.api_requests.context import build_context
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry, to_ai_error
+from app.open_webapp_bot.AI.api_requests.client import get_client, stream_completion
 
-API = os.getenv('API_GPT')
 
-
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=API,
-)
-
-
-async def gpt_5(session: AsyncSession, user_id: int, prompt: str = None, image = None,):
-    print('gpt-5')
+async def add_gpt_user_message(session: AsyncSession, user_id: int, prompt: str = None, image = None,):
+    if image:
+        image = await orm_save_image(session, image)
 
     if image and prompt:
         await orm_update_gpt_chat_history(session, [{
@@ -30,7 +24,7 @@ async def gpt_5(session: AsyncSession, user_id: int, prompt: str = None, image =
         {
           "type": "image_url",
           "image_url": {
-            "url": f"data:image/jpeg;base64,{image}"
+            "url": image
           }
         }
       ]
@@ -49,7 +43,7 @@ async def gpt_5(session: AsyncSession, user_id: int, prompt: str = None, image =
         {
           "type": "image_url",
           "image_url": {
-            "url": f"data:image/jpeg;base64,{image}"
+            "url": image
           }
         }
       ],
@@ -61,27 +55,49 @@ async def gpt_5(session: AsyncSession, user_id: int, prompt: str = None, image =
             "role": "user",
             "content": prompt},
         ], user_id)
-    history = await orm_get_chat_history(session, user_id, 'gpt')
-    print(history)
-    try:
 
 
+async def gpt_5(session: AsyncSession, user_id: int, prompt: str = None, image = None,):
+    print('gpt-5')
 
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="openai/gpt-5",
-            messages=history
-        )
+    await add_gpt_user_message(session, user_id, prompt, image)
+    history = await build_context(session, user_id, 'gpt')
+    history = await expand_image_refs(history)
+    response = await call_with_retry("openai/gpt-5", lambda: get_client().chat.completions.create(
+        model="openai/gpt-5",
+        messages=history
+    ))
 
-        print(response)
-        ans = response.choices[0].message.content
-        await orm_update_gpt_chat_history(session, [
-            {"role": "assistant", "content": ans}
-        ], user_id)
+    print(response)
+    ans = response.choices[0].message.content
+    await orm_update_gpt_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
+
+    return ans
 
 
-        return ans
+async def gpt_5_stream(session: AsyncSession, user_id: int, prompt: str = None, image = None,):
+    print('gpt-5 stream')
+
+    await add_gpt_user_message(session, user_id, prompt, image)
+    history = await build_context(session, user_id, 'gpt')
+    history = await expand_image_refs(history)
+
+    ans = ''
+    try:
+        async for delta in stream_completion("openai/gpt-5", history):
+            ans += delta
+            yield delta
 
     except Exception as e:
-        print(e)
-        return 'К сожалению, произошла ошибка. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+        # недописанный ответ всё равно сохраняем в историю
+        if ans:
+            await orm_update_gpt_chat_history(session, [
+                {"role": "assistant", "content": ans}
+            ], user_id)
+        raise to_ai_error("openai/gpt-5", e) from e
+
+    await orm_update_gpt_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
@@ -1,24 +1,18 @@
-import asyncio
 import base64
-import os
 
-from openai import OpenAI
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.open_webapp_bot.AI.database.orm_query import orm_get_chat_history, \
+from app.open_webapp_bot.AI.database.orm_query import orm_save_image, \
     orm_update_perplexity_chat_history
+from app.open_webapp_bot.AI.database.blob_store import expand_image_refs
+from app.open_webapp_bot.AI.api_requests.context import build_context
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry, to_ai_error
+from app.open_webapp_bot.AI.api_requests.client import get_client, stream_completion
 
-API = os.getenv('API_GPT')
 
-
-client = OpenAI(
-  base_url="https://openrouter.ai/api/v1",
-  api_key=API,
-)
-
-
-async def perp_send_request(session: AsyncSession, user_id: int, prompt: str = None, image = None):
-    print('to perplexity')
+async def add_perplexity_user_message(session: AsyncSession, user_id: int, prompt: str = None, image = None):
+    if image:
+        image = await orm_save_image(session, image)
 
     if image and prompt:
         await orm_update_perplexity_chat_history(session, [{
@@ -31,7 +25,7 @@ async def perp_send_request(session: AsyncSession, user_id: int, prompt: str = N
         {
           "type": "image_url",
           "image_url": {
-            "url": f"data:image/jpeg;base64,{image}"
+            "url": image
           }
         }
       ]
@@ -49,7 +43,7 @@ async def perp_send_request(session: AsyncSession, user_id: int, prompt: str = N
         {
           "type": "image_url",
           "image_url": {
-            "url": f"data:image/jpeg;base64,{image}"
+            "url": image
           }
         }
       ],
@@ -64,25 +58,50 @@ async def perp_send_request(session: AsyncSession, user_id: int, prompt: str = N
         ], user_id)
         print('udated')
 
-    history = await orm_get_chat_history(session, user_id, 'perplexity')
-    print(history)
-    try:
 
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="perplexity/sonar-pro",
-            messages=history
-        )
+async def perp_send_request(session: AsyncSession, user_id: int, prompt: str = None, image = None):
+    print('to perplexity')
+
+    await add_perplexity_user_message(session, user_id, prompt, image)
+    history = await build_context(session, user_id, 'perplexity')
+    history = await expand_image_refs(history)
+    response = await call_with_retry("perplexity/sonar-pro", lambda: get_client().chat.completions.create(
+        model="perplexity/sonar-pro",
+        messages=history
+    ))
+
+    print(response)
+    ans = response.choices[0].message.content
+    await orm_update_perplexity_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
+
+    print(response.citations)
+    return ans, response.citations
 
-        print(response)
-        ans = response.choices[0].message.content
-        await orm_update_perplexity_chat_history(session, [
-            {"role": "assistant", "content": ans}
-        ], user_id)
 
-        print(response.citations)
-        return ans, response.citations
+async def perp_stream_request(session: AsyncSession, user_id: int, prompt: str = None, image = None, extra: dict = None):
+    # ссылки на источники складываются в extra['citations']
+    print('to perplexity stream')
+
+    await add_perplexity_user_message(session, user_id, prompt, image)
+    history = await build_context(session, user_id, 'perplexity')
+    history = await expand_image_refs(history)
+
+    ans = ''
+    try:
+        async for delta in stream_completion("perplexity/sonar-pro", history, extra):
+            ans += delta
+            yield delta
 
     except Exception as e:
-        print(e)
-        return 'К сожалению, произошла ошибка. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+        # недописанный ответ всё равно сохраняем в историю
+        if ans:
+            await orm_update_perplexity_chat_history(session, [
+                {"role": "assistant", "content": ans}
+            ], user_id)
+        raise to_ai_error("perplexity/sonar-pro", e) from e
+
+    await orm_update_perplexity_chat_history(session, [
+        {"role": "assistant", "content": ans}
+    ], user_id)
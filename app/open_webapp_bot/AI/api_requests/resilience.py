@@ -0,0 +1,147 @@
+import asyncio
+import os
+import random
+import time
+
+import httpx
+import openai
+import aiohttp
+from dotenv import load_dotenv, find_dotenv
+
+# первым импортируется через client.py, раньше, чем main.py загружает .env
+load_dotenv(find_dotenv())
+
+RETRY_ATTEMPTS = int(os.getenv('AI_RETRY_ATTEMPTS', 3))
+RETRY_BASE_DELAY = float(os.getenv('AI_RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('AI_RETRY_MAX_DELAY', 20))
+BREAKER_THRESHOLD = int(os.getenv('AI_BREAKER_THRESHOLD', 5))
+BREAKER_RESET = float(os.getenv('AI_BREAKER_RESET', 30))
+
+ERROR_TEXT = ('К сожалению, произошла ошибка. Пожалуйста, повторите попытку\n'
+              'Если ошибка продолжает возникать, дайте нам знать @aitb_support')
+
+
+class AIRequestError(Exception):
+    # kind: rate_limited, server, network, timeout, moderation, bad_request, empty, circuit_open
+    def __init__(self, model: str, kind: str, status: int = None, code: str = None, retry_after: float = None,
+                 detail: str = ''):
+        super().__init__(f'{model}: {kind} {status or ""} {detail}'.strip())
+        self.model = model
+        self.kind = kind
+        self.status = status
+        self.code = code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in ('rate_limited', 'server', 'network', 'timeout')
+
+    @property
+    def user_message(self) -> str:
+        if self.kind == 'moderation':
+            return '🤖 К сожалению, я не могу выполнить этот запрос, так как он противоречит моей политике в отношении контента.'
+        if self.kind == 'circuit_open':
+            return '⏳ Модель временно недоступна, пожалуйста, повторите попытку через пару минут'
+        return ERROR_TEXT
+
+
+def _retry_after(headers) -> float | None:
+    if not headers:
+        return None
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def to_ai_error(model: str, e: Exception) -> AIRequestError:
+    if isinstance(e, AIRequestError):
+        return e
+    if isinstance(e, openai.APITimeoutError) or isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+        return AIRequestError(model, 'timeout', detail=str(e))
+    if isinstance(e, openai.APIConnectionError) or isinstance(e, (httpx.TransportError, aiohttp.ClientConnectionError)):
+        return AIRequestError(model, 'network', detail=str(e))
+    if isinstance(e, openai.APIStatusError):
+        code = getattr(e, 'code', None)
+        retry_after = _retry_after(e.response.headers)
+        if code == 'moderation_blocked':
+            return AIRequestError(model, 'moderation', e.status_code, code)
+        if e.status_code == 429:
+            return AIRequestError(model, 'rate_limited', 429, code, retry_after)
+        if e.status_code >= 500:
+            return AIRequestError(model, 'server', e.status_code, code, retry_after)
+        return AIRequestError(model, 'bad_request', e.status_code, code, detail=str(e))
+    return AIRequestError(model, 'bad_request', detail=repr(e))
+
+
+class CircuitBreaker:
+    # После BREAKER_THRESHOLD ошибок подряд модель считается недоступной на BREAKER_RESET секунд,
+    # затем пропускается один пробный запрос
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.failures += 1
+        self.trial = False
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(model: str) -> CircuitBreaker:
+    if model not in breakers:
+        breakers[model] = CircuitBreaker()
+    return breakers[model]
+
+
+async def call_with_retry(model: str, request, attempts: int = RETRY_ATTEMPTS, idempotent: bool = True):
+    # request - функция без аргументов, возвращающая корутину запроса
+    breaker = get_breaker(model)
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise AIRequestError(model, 'circuit_open')
+        try:
+            result = await request()
+        except Exception as e:
+            error = to_ai_error(model, e)
+            print(error)
+            if error.retryable:
+                breaker.failure()
+            else:
+                breaker.success()
+
+            # неидемпотентный запрос повторяем, только если сервер его точно отклонил
+            can_retry = error.retryable and (idempotent or error.kind == 'rate_limited')
+            if not can_retry or attempt == attempts - 1:
+                raise error from e
+
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            if error.retry_after:
+                delay = max(delay, min(error.retry_after, RETRY_MAX_DELAY))
+            await asyncio.sleep(delay)
+        else:
+            breaker.success()
+            return result
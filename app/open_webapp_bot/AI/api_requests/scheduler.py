@@ -0,0 +1,144 @@
+import asyncio
+import itertools
+import os
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, default))
+
+
+# Сколько запросов к каждой модели может идти одновременно
+MODEL_LIMITS = {
+    'nano_banana': _env_int('AI_LIMIT_NANO_BANANA', 8),
+    'gpt_5': _env_int('AI_LIMIT_GPT_5', 32),
+    'perplexity': _env_int('AI_LIMIT_PERPLEXITY', 32),
+    'deepseek': _env_int('AI_LIMIT_DEEPSEEK', 32),
+    'grok': _env_int('AI_LIMIT_GROK', 16),
+}
+# Веса для справедливой очереди: чем больше вес, тем чаще модель получает свободный слот
+MODEL_WEIGHTS = {
+    'nano_banana': _env_int('AI_WEIGHT_NANO_BANANA', 1),
+    'gpt_5': _env_int('AI_WEIGHT_GPT_5', 2),
+    'perplexity': _env_int('AI_WEIGHT_PERPLEXITY', 2),
+    'deepseek': _env_int('AI_WEIGHT_DEEPSEEK', 4),
+    'grok': _env_int('AI_WEIGHT_GROK', 2),
+}
+USER_LIMIT = _env_int('AI_USER_LIMIT', 2)
+TOTAL_LIMIT = _env_int('AI_TOTAL_LIMIT', 64)
+
+
+class _Job:
+    __slots__ = ('model', 'user_id', 'tag', 'order', 'future', 'enqueued')
+
+    def __init__(self, model: str, user_id: int, tag: float, order: int):
+        self.model = model
+        self.user_id = user_id
+        self.tag = tag
+        self.order = order
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = asyncio.get_running_loop().time()
+
+
+class AIScheduler:
+    # Очередь запросов к моделям: лимит на модель, лимит на пользователя и взвешенная справедливая очередь между моделями
+    def __init__(self, model_limits: dict, weights: dict, user_limit: int, total_limit: int):
+        self.model_limits = model_limits
+        self.weights = weights
+        self.user_limit = user_limit
+        self.total_limit = total_limit
+
+        self.queue: list[_Job] = []
+        self.running = defaultdict(int)
+        self.user_running = defaultdict(int)
+        self.total_running = 0
+
+        self.vtime = 0.0
+        self.last_tag = defaultdict(float)
+        self.counter = itertools.count()
+
+        self.served = defaultdict(int)
+        self.wait_total = defaultdict(float)
+        self.wait_max = defaultdict(float)
+
+    def _eligible(self, job: _Job) -> bool:
+        return (self.total_running < self.total_limit
+                and self.running[job.model] < self.model_limits.get(job.model, self.total_limit)
+                and self.user_running[job.user_id] < self.user_limit)
+
+    def _dispatch(self):
+        while self.queue:
+            candidates = [job for job in self.queue if self._eligible(job)]
+            if not candidates:
+                return
+            job = min(candidates, key=lambda j: (j.tag, j.order))
+            self.queue.remove(job)
+            self.vtime = max(self.vtime, job.tag)
+            self._start(job)
+            job.future.set_result(None)
+
+    def _start(self, job: _Job):
+        self.running[job.model] += 1
+        self.user_running[job.user_id] += 1
+        self.total_running += 1
+
+    def _finish(self, job: _Job):
+        self.running[job.model] -= 1
+        self.user_running[job.user_id] -= 1
+        if not self.user_running[job.user_id]:
+            del self.user_running[job.user_id]
+        self.total_running -= 1
+        self._dispatch()
+
+    def position(self, job: _Job) -> int:
+        return sum(1 for other in self.queue if (other.tag, other.order) < (job.tag, job.order)) + 1
+
+    @asynccontextmanager
+    async def slot(self, model: str, user_id: int, on_queued=None):
+        tag = max(self.vtime, self.last_tag[model]) + 1 / self.weights.get(model, 1)
+        self.last_tag[model] = tag
+        job = _Job(model, user_id, tag, next(self.counter))
+        self.queue.append(job)
+        self._dispatch()
+
+        try:
+            if not job.future.done():
+                if on_queued:
+                    try:
+                        await on_queued(self.position(job))
+                    except Exception as e:
+                        print(e)
+                await job.future
+        except BaseException:
+            if job in self.queue:
+                self.queue.remove(job)
+            elif job.future.done():
+                self._finish(job)
+            raise
+
+        wait = asyncio.get_running_loop().time() - job.enqueued
+        self.served[model] += 1
+        self.wait_total[model] += wait
+        self.wait_max[model] = max(self.wait_max[model], wait)
+
+        try:
+            yield
+        finally:
+            self._finish(job)
+
+    def stats(self) -> dict:
+        queued = defaultdict(int)
+        for job in self.queue:
+            queued[job.model] += 1
+
+        return {model: {
+            'running': self.running[model],
+            'queued': queued[model],
+            'served': self.served[model],
+            'avg_wait': self.wait_total[model] / self.served[model] if self.served[model] else 0.0,
+            'max_wait': self.wait_max[model],
+        } for model in self.model_limits}
+
+
+scheduler = AIScheduler(MODEL_LIMITS, MODEL_WEIGHTS, USER_LIMIT, TOTAL_LIMIT)
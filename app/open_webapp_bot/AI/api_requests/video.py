@@ -1,13 +1,36 @@
-import asyncio
 import os
 
-from aiogram.client.session import aiohttp
+import aiohttp
+from aiohttp import ClientResponse
+
+from app.open_webapp_bot.AI.api_requests.resilience import call_with_retry, AIRequestError
 
 API = os.getenv('API_VIDEO')
 
+
+async def raise_for_status(response: ClientResponse, model: str):
+    if response.status in (200, 201):
+        return
+    text = await response.text()
+    retry_after = response.headers.get('Retry-After')
+    retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+    if response.status == 429:
+        raise AIRequestError(model, 'rate_limited', 429, retry_after=retry_after, detail=text)
+    if response.status >= 500:
+        raise AIRequestError(model, 'server', response.status, retry_after=retry_after, detail=text)
+    raise AIRequestError(model, 'bad_request', response.status, detail=text)
+
+
+URL_BYTEDANCE = "https://api.aimlapi.com/v2/generate/video/bytedance/generation"
+# url_veo3 = "https://api.aimlapi.com/v2/generate/video/google/generation"
+VIDEO_MODEL = 'bytedance/seedance-1-0-lite'
+
+# статусы aimlapi, при которых генерация ещё идёт
+PENDING_STATUSES = ("waiting", "active", "queued", "generating")
+
+
 async def veo_text_to_video(http_session: aiohttp.ClientSession, prompt: str, ratio: str, image = None, long: bool | None = None):
-    # url_veo3 = "https://api.aimlapi.com/v2/generate/video/google/generation"
-    url_bytedance = "https://api.aimlapi.com/v2/generate/video/bytedance/generation"
+    """Создаёт генерацию и возвращает её id, дальше её опрашивает VideoTracker"""
     if long:
         duration = 10
     else:
@@ -17,7 +40,7 @@ async def veo_text_to_video(http_session: aiohttp.ClientSession, prompt: str, ra
 
 
         payload = {
-            "model": f"bytedance/seedance-1-0-lite-i2v",
+            "model": f"{VIDEO_MODEL}-i2v",
             'image_url': image,
             "prompt": prompt,
             "duration": duration,
@@ -25,7 +48,7 @@ async def veo_text_to_video(http_session: aiohttp.ClientSession, prompt: str, ra
     else:
 
         payload = {
-            "model": f"bytedance/seedance-1-0-lite-t2v",
+            "model": f"{VIDEO_MODEL}-t2v",
             "prompt": prompt,
             "aspect_ratio": ratio,
             "duration": duration,
@@ -33,36 +56,34 @@ async def veo_text_to_video(http_session: aiohttp.ClientSession, prompt: str, ra
 
     headers = {"Authorization": f"Bearer {API}"}
 
-    async with http_session.post(url_bytedance, json=payload, headers=headers) as response:
-        data = await response.json()
-        print(data)
-        generation_id = data['id']
-
-    while True:
-        params = {"generation_id": generation_id}
-        async with http_session.get(url_bytedance, headers=headers, params=params) as response:
-            if response.status != 200:
-                # Обработка ошибок HTTP
-                text = await response.text()
-                raise Exception(f"HTTP error {response.status}: {text}")
-            data = await response.json()
-        status = data.get('status')
-        print("Текущий статус:", status)
-        if status in ["waiting", "active", "queued", "generating"]:
-            print("Видео еще генерируется, ждем 10 секунд...")
-            await asyncio.sleep(10)
-
-        elif status == "completed":
-            video_url = data.get("video", {}).get("url")
-            print(data)
-            print("Видео готово! Ссылка:", video_url)
-            return video_url
-
-        else:
-            print("Получен неожиданный статус или ошибка:", data)
-            return
-
-
+    async def create_generation():
+        async with http_session.post(URL_BYTEDANCE, json=payload, headers=headers) as response:
+            await raise_for_status(response, payload['model'])
+            return await response.json()
 
+    # генерация платная, поэтому повторяем создание только если сервер точно её отклонил
+    data = await call_with_retry(payload['model'], create_generation, idempotent=False)
+    print(data)
+    return data['id']
 
 
+async def veo_get_generation(http_session: aiohttp.ClientSession, generation_id: str):
+    """Один запрос статуса генерации: (status, video_url)"""
+    headers = {"Authorization": f"Bearer {API}"}
+    params = {"generation_id": generation_id}
+
+    async def get_status():
+        async with http_session.get(URL_BYTEDANCE, headers=headers, params=params) as response:
+            await raise_for_status(response, VIDEO_MODEL)
+            return await response.json()
+
+    # повторы здесь не нужны: трекер сам опросит генерацию в следующем цикле
+    data = await call_with_retry(VIDEO_MODEL, get_status, attempts=1)
+    status = data.get('status')
+    print("Текущий статус:", generation_id, status)
+    if status in PENDING_STATUSES:
+        return 'pending', None
+    if status == "completed":
+        return 'completed', data.get("video", {}).get("url")
+    print("Получен неожиданный статус или ошибка:", data)
+    return 'failed', None
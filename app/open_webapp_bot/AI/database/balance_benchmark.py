@@ -0,0 +1,89 @@
+"""QPS orm_get_balance при разных настройках движка (см. engine_config.py).
+
+    python -m app.open_webapp_bot.AI.database.balance_benchmark --pool-sizes 5 10 20 --cache-sizes 0 500
+
+Для каждой комбинации --pool-sizes x --cache-sizes x --pre-ping создаётся свой движок,
+--concurrency задач --duration секунд подряд проверяют баланс случайных пользователей,
+каждая проверка в своей сессии, как в обработчиках. Медленные запросы не логируются.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+
+from dotenv import load_dotenv, find_dotenv
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from app.open_webapp_bot.AI.database.engine_config import engine_options
+from app.open_webapp_bot.AI.database.orm_query import orm_get_balance
+from app.open_webapp_bot.AI.database.user_cache import user_cache
+from app.open_webapp_bot.AI.database.session_benchmark import BENCH_USER_ID, percentile, create_bench_users, \
+    drop_bench_users
+
+
+async def measure(url: str, pool_size: int, cache_size: int, pre_ping: bool, args) -> dict:
+    engine = create_async_engine(url, **engine_options(url, statement_cache_size=cache_size, echo=False,
+                                                      pool_size=pool_size, max_overflow=0, pool_pre_ping=pre_ping))
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    latencies = []
+
+    async def worker(deadline: float):
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            async with session_pool() as session:
+                await orm_get_balance(session, BENCH_USER_ID + random.randrange(args.users))
+            latencies.append(time.perf_counter() - start)
+
+    try:
+        # прогрев: соединения открыты, выражения подготовлены
+        await asyncio.gather(*(worker(time.perf_counter() + 0.5) for _ in range(pool_size)))
+        latencies.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(start + args.duration) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        await engine.dispose()
+
+    return {
+        'pool_size': pool_size,
+        'statement_cache': cache_size,
+        'pre_ping': pre_ping,
+        'qps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def run(args) -> list[dict]:
+    engine = create_async_engine(args.url)
+    await create_bench_users(engine, args.users, 1)
+    try:
+        return [await measure(args.url, pool_size, cache_size, pre_ping, args)
+                for pool_size, cache_size, pre_ping in itertools.product(
+                    args.pool_sizes, args.cache_sizes, [bool(p) for p in args.pre_ping])]
+    finally:
+        await drop_bench_users(engine)
+        await engine.dispose()
+
+
+def main():
+    load_dotenv(find_dotenv())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.getenv('DB_URL'))
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[5, 10, 20])
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[0, 100, 500])
+    parser.add_argument('--pre-ping', type=int, nargs='+', default=[1, 0], choices=[0, 1])
+    args = parser.parse_args()
+    # меряем базу, а не кэш профилей
+    user_cache.ttl = 0
+    print(json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
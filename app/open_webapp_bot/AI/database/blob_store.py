@@ -0,0 +1,108 @@
+import asyncio
+import base64
+import hashlib
+import os
+
+# Хранилище картинок по sha256: files/blobs/ab/cd/abcd...
+BLOB_DIR = os.getenv('BLOB_DIR', 'app/open_webapp_bot/AI/files/blobs')
+IMAGE_REF_PREFIX = 'blob:'
+# Сколько последних картинок из истории отправлять модели, более старые выкидываются из запроса
+HISTORY_IMAGE_TURNS = int(os.getenv('HISTORY_IMAGE_TURNS', 3))
+
+
+def blob_path(digest: str) -> str:
+    return os.path.join(BLOB_DIR, digest[:2], digest[2:4], digest)
+
+
+def _write_blob(digest: str, data: bytes):
+    path = blob_path(digest)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _read_blob(digest: str) -> bytes | None:
+    try:
+        with open(blob_path(digest), 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _remove_blob(digest: str):
+    try:
+        os.remove(blob_path(digest))
+    except FileNotFoundError:
+        pass
+
+
+async def put_blob(data: bytes) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    await asyncio.to_thread(_write_blob, digest, data)
+    return digest
+
+
+async def get_blob(digest: str) -> bytes | None:
+    return await asyncio.to_thread(_read_blob, digest)
+
+
+async def delete_blobs(digests: list[str]):
+    for digest in digests:
+        await asyncio.to_thread(_remove_blob, digest)
+
+
+def make_image_ref(digest: str) -> str:
+    return f'{IMAGE_REF_PREFIX}{digest}'
+
+
+def image_refs(content) -> list[str]:
+    # sha256 всех картинок, на которые ссылается сообщение из истории
+    refs = []
+    if isinstance(content, list):
+        for part in content:
+            if isinstance(part, dict) and part.get('type') == 'image_url':
+                url = part.get('image_url', {}).get('url', '')
+                if url.startswith(IMAGE_REF_PREFIX):
+                    refs.append(url[len(IMAGE_REF_PREFIX):])
+    return refs
+
+
+async def expand_image_refs(history: list, keep_images: int = HISTORY_IMAGE_TURNS) -> list:
+    # Подставляем data URI вместо ссылок только при сборке запроса к модели
+    image_messages = [i for i, message in enumerate(history)
+                      if isinstance(message['content'], list)
+                      and any(isinstance(part, dict) and part.get('type') == 'image_url' for part in message['content'])]
+    keep = set(image_messages[-keep_images:]) if keep_images > 0 else set()
+    image_messages = set(image_messages)
+
+    expanded = []
+    for i, message in enumerate(history):
+        if i not in image_messages:
+            expanded.append(message)
+            continue
+
+        content = []
+        for part in message['content']:
+            if not (isinstance(part, dict) and part.get('type') == 'image_url'):
+                content.append(part)
+                continue
+            if i not in keep:
+                continue
+
+            url = part['image_url']['url']
+            if url.startswith(IMAGE_REF_PREFIX):
+                data = await get_blob(url[len(IMAGE_REF_PREFIX):])
+                if data is None:
+                    continue
+                url = f'data:image/jpeg;base64,{base64.b64encode(data).decode("utf-8")}'
+            content.append({'type': 'image_url', 'image_url': {'url': url}})
+
+        if not content:
+            content = [{'type': 'text', 'text': ''}]
+        expanded.append({**message, 'content': content})
+
+    return expanded
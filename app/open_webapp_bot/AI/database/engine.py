@@ -1,20 +1,34 @@
 import os
 
 from dotenv import load_dotenv, find_dotenv
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
+from app.open_webapp_bot.AI.database.engine_config import create_engine
+from app.open_webapp_bot.AI.database.lazy_session import LazySession
 from app.open_webapp_bot.AI.database.models import Base
+from app.open_webapp_bot.AI.database.migrations import migrate_chat_histories, migrate_promo_redemptions, \
+    migrate_inline_images
 
 load_dotenv(find_dotenv())
 url = os.getenv('DB_URL')
 # print(url)
-engine = create_async_engine(url, echo=True)
+engine = create_engine(url)
 
 session_maker = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
+# Сессии для обработчиков апдейтов: lazy - соединение берётся только на время запроса и не держится,
+# пока обработчик ждёт ответа модели (см. lazy_session.py), request - одно соединение на весь апдейт
+DB_SESSION_MODE = os.getenv('DB_SESSION_MODE', 'lazy')
+handler_session_maker = async_sessionmaker(
+    bind=engine, class_=LazySession if DB_SESSION_MODE == 'lazy' else AsyncSession, expire_on_commit=False
+)
+
 async def create_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    await migrate_chat_histories(engine)
+    await migrate_promo_redemptions(engine)
+    await migrate_inline_images(engine)
 
 async def drop_db():
     async with engine.begin() as conn:
@@ -0,0 +1,65 @@
+import json
+import os
+import time
+
+from dotenv import load_dotenv, find_dotenv
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+
+load_dotenv(find_dotenv())
+
+# Настройки движка из окружения. DB_ECHO=1 включает логирование всех запросов (только для отладки),
+# в обычной работе пишутся только запросы дольше DB_SLOW_QUERY_MS (0 - не писать)
+DB_ECHO = os.getenv('DB_ECHO', '0') == '1'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 30))
+# проверка соединения перед выдачей из пула, переживает перезапуск Postgres и обрывы по idle timeout
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 30 * 60))
+# кэш подготовленных выражений asyncpg на соединение; за pgbouncer в режиме transaction нужен 0
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', 500))
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 200))
+
+
+def engine_options(url: str, statement_cache_size: int = DB_STATEMENT_CACHE_SIZE, **overrides) -> dict:
+    options = {
+        'echo': DB_ECHO,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE,
+    }
+    if url.startswith('postgresql+asyncpg'):
+        options['connect_args'] = {'prepared_statement_cache_size': statement_cache_size}
+        if statement_cache_size == 0:
+            # собственный кэш asyncpg тоже отключаем
+            options['connect_args']['statement_cache_size'] = 0
+    options.update(overrides)
+    return options
+
+
+def log_slow_queries(engine: AsyncEngine, threshold_ms: float = DB_SLOW_QUERY_MS):
+    # Одна строка JSON на медленный запрос: время и текст запроса без параметров
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context.query_start = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = (time.perf_counter() - context.query_start) * 1000
+        if elapsed >= threshold_ms:
+            print(json.dumps({
+                'event': 'slow_query',
+                'ms': round(elapsed, 1),
+                'statement': ' '.join(statement.split())[:1000],
+                'executemany': executemany,
+            }, ensure_ascii=False))
+
+
+def create_engine(url: str, **overrides) -> AsyncEngine:
+    engine = create_async_engine(url, **engine_options(url, **overrides))
+    if DB_SLOW_QUERY_MS > 0:
+        log_slow_queries(engine)
+    return engine
@@ -0,0 +1,178 @@
+import hashlib
+import os
+import time
+from datetime import timedelta
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+from sqlalchemy import select, delete, func, case, cast
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.open_webapp_bot.AI.database.models import FsmState, FsmBlob
+
+# Состояния пользователей, которые ничего не делали дольше FSM_STATE_TTL, считаются сброшенными
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', 7 * 24 * 60 * 60))
+FSM_CLEANUP_INTERVAL = float(os.getenv('FSM_CLEANUP_INTERVAL', 60 * 60))
+# bytes и строки длиннее этого лимита уходят в fsm_blob, в данных остаётся ссылка
+FSM_INLINE_LIMIT = int(os.getenv('FSM_INLINE_LIMIT', 16 * 1024))
+
+BLOB_MARK = '__fsm_blob__'
+
+
+class SQLAlchemyStorage(BaseStorage):
+    # FSM хранилище в Postgres: состояние переживает перезапуск и общее для всех процессов бота
+    def __init__(self, session_pool: async_sessionmaker, state_ttl: float = FSM_STATE_TTL,
+                 inline_limit: int = FSM_INLINE_LIMIT):
+        self.session_pool = session_pool
+        self.state_ttl = state_ttl
+        self.inline_limit = inline_limit
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.next_cleanup = 0.0
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    def _encode(self, value, blobs: dict):
+        # bytes и длинные строки заменяются ссылкой {BLOB_MARK: sha256, 'type': ...}
+        if isinstance(value, (bytes, bytearray)) or (isinstance(value, str) and len(value) > self.inline_limit):
+            kind = 'str' if isinstance(value, str) else 'bytes'
+            data = value.encode('utf-8') if kind == 'str' else bytes(value)
+            digest = hashlib.sha256(data).hexdigest()
+            blobs[digest] = data
+            return {BLOB_MARK: digest, 'type': kind}
+        if isinstance(value, Mapping):
+            return {k: self._encode(v, blobs) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._encode(v, blobs) for v in value]
+        return value
+
+    def _refs(self, value, refs: set):
+        if isinstance(value, dict):
+            if BLOB_MARK in value:
+                refs.add(value[BLOB_MARK])
+            else:
+                for v in value.values():
+                    self._refs(v, refs)
+        elif isinstance(value, list):
+            for v in value:
+                self._refs(v, refs)
+        return refs
+
+    def _decode(self, value, blobs: dict):
+        if isinstance(value, dict):
+            if BLOB_MARK in value:
+                data = blobs.get(value[BLOB_MARK])
+                if data is None:
+                    return None
+                return data.decode('utf-8') if value['type'] == 'str' else data
+            return {k: self._decode(v, blobs) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._decode(v, blobs) for v in value]
+        return value
+
+    async def _cleanup(self, session):
+        # Удаляем просроченные состояния не чаще раза в FSM_CLEANUP_INTERVAL
+        if time.monotonic() < self.next_cleanup:
+            return
+        self.next_cleanup = time.monotonic() + FSM_CLEANUP_INTERVAL
+        expired = select(FsmState.key).where(FsmState.updated < self._expired_before())
+        await session.execute(delete(FsmBlob).where(FsmBlob.key.in_(expired)))
+        await session.execute(delete(FsmState).where(FsmState.updated < self._expired_before()))
+
+    def _expired_before(self):
+        # граница считается на стороне базы: updated пишется через func.now() в её часовом поясе
+        return func.now() - timedelta(seconds=self.state_ttl)
+
+    async def _get_row(self, session, key: str):
+        query = select(FsmState.state, FsmState.data).where(
+            FsmState.key == key, FsmState.updated >= self._expired_before()
+        )
+        return (await session.execute(query)).first()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        async with self.session_pool() as session:
+            query = insert(FsmState).values(key=self._key(key), state=state, data={}).on_conflict_do_update(
+                index_elements=[FsmState.key], set_={
+                    'state': state,
+                    # данные просроченного состояния не должны ожить вместе с новым состоянием
+                    'data': case((FsmState.updated < self._expired_before(), cast({}, JSONB)), else_=FsmState.data),
+                    'updated': func.now(),
+                }
+            )
+            await session.execute(query)
+            await self._cleanup(session)
+            await session.commit()
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        async with self.session_pool() as session:
+            row = await self._get_row(session, self._key(key))
+        return row.state if row else None
+
+    async def _write_data(self, session, key: str, data: dict, blobs: dict):
+        refs = self._refs(data, set())
+        # кладём только новые блобы и удаляем те, на которые данные больше не ссылаются
+        stored = set((await session.execute(select(FsmBlob.sha256).where(FsmBlob.key == key))).scalars())
+        new = [{'key': key, 'sha256': digest, 'data': blobs[digest]} for digest in refs - stored if digest in blobs]
+        if new:
+            await session.execute(insert(FsmBlob).values(new).on_conflict_do_nothing())
+        if stored - refs:
+            await session.execute(delete(FsmBlob).where(FsmBlob.key == key, FsmBlob.sha256.in_(stored - refs)))
+
+        query = insert(FsmState).values(key=key, data=data).on_conflict_do_update(
+            index_elements=[FsmState.key], set_={'data': data, 'updated': func.now()}
+        )
+        await session.execute(query)
+        await self._cleanup(session)
+        await session.commit()
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        blobs = {}
+        encoded = self._encode(dict(data), blobs)
+        async with self.session_pool() as session:
+            await self._write_data(session, self._key(key), encoded, blobs)
+
+    async def _lock_data(self, session, key: str) -> dict:
+        # Строка создаётся, если её ещё нет, и блокируется до commit:
+        # параллельные update_data одного ключа (другие процессы, пул вебхука) выполняются по очереди
+        await session.execute(insert(FsmState).values(key=key, data={}).on_conflict_do_nothing())
+        query = select(FsmState.data, (FsmState.updated < self._expired_before()).label('expired')).where(
+            FsmState.key == key).with_for_update()
+        row = (await session.execute(query)).first()
+        if row is None or row.expired:
+            return {}
+        return dict(row.data or {})
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        # Сливаем с уже закодированными данными, а из базы читаем только те блобы,
+        # которые остались от прошлых значений
+        blobs = {}
+        encoded = self._encode(dict(data), blobs)
+        storage_key = self._key(key)
+        async with self.session_pool() as session:
+            current = await self._lock_data(session, storage_key)
+            current.update(encoded)
+            await self._write_data(session, storage_key, current, blobs)
+            blobs.update(await self._read_blobs(session, storage_key, self._refs(current, set()) - set(blobs)))
+        return self._decode(current, blobs)
+
+    async def _read_blobs(self, session, key: str, refs: set) -> dict:
+        if not refs:
+            return {}
+        query = select(FsmBlob.sha256, FsmBlob.data).where(FsmBlob.key == key, FsmBlob.sha256.in_(refs))
+        return {digest: data for digest, data in await session.execute(query)}
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        storage_key = self._key(key)
+        async with self.session_pool() as session:
+            row = await self._get_row(session, storage_key)
+            if not row or not row.data:
+                return {}
+            blobs = await self._read_blobs(session, storage_key, self._refs(row.data, set()))
+        return self._decode(row.data, blobs)
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,127 @@
+"""Стресс-тест дописывания истории диалога: параллельные записи не должны терять реплики.
+
+    python -m app.open_webapp_bot.AI.database.history_lock_stress --users 20 --turns 50
+    python -m app.open_webapp_bot.AI.database.history_lock_stress --processes 4 --backend postgres
+    python -m app.open_webapp_bot.AI.database.history_lock_stress --unlocked
+
+Каждый процесс (--processes) для каждого из --users пользователей одновременно запускает --turns
+записей через orm_update_gpt_chat_history, каждую в своей сессии, как в обработчиках. Потом
+проверяется, что у каждого пользователя ровно processes * turns реплик и seq идут подряд с 1.
+--unlocked пишет через orm_add_chat_messages без замка - так видно, что без него реплики теряются.
+Несколько процессов сериализуются только с --backend postgres. База из DB_URL (или --url),
+пользователи с user_id от BENCH_USER_ID, их история удаляется до и после прогона.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+
+from dotenv import load_dotenv, find_dotenv
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from app.open_webapp_bot.AI.database.keyed_lock import history_locks
+from app.open_webapp_bot.AI.database.models import Base, ChatMessage
+from app.open_webapp_bot.AI.database.orm_query import orm_update_gpt_chat_history, orm_add_chat_messages
+from app.open_webapp_bot.AI.database.session_benchmark import BENCH_USER_ID
+
+MODEL = 'gpt'
+
+
+async def append_all(args, process_number: int) -> dict:
+    history_locks.backend = args.backend
+    engine = create_async_engine(args.url, pool_size=args.pool_size, max_overflow=0)
+    session_pool = async_sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    failed = 0
+
+    async def append(user_id: int, turn: int):
+        nonlocal failed
+        chat = [{'role': 'user', 'content': f'{process_number}:{turn}'}]
+        try:
+            async with session_pool() as session:
+                if args.unlocked:
+                    await orm_add_chat_messages(session, chat, user_id, MODEL)
+                else:
+                    await orm_update_gpt_chat_history(session, chat, user_id)
+        except Exception:
+            # конфликт по (user_id, model, seq): реплика потеряна
+            failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(append(BENCH_USER_ID + user, turn)
+                           for turn in range(args.turns) for user in range(args.users)))
+    elapsed = time.perf_counter() - start
+    await engine.dispose()
+    return {'failed': failed, 'seconds': elapsed, 'locks_left': len(history_locks)}
+
+
+def run_process(args, process_number: int, results):
+    results.put(asyncio.run(append_all(args, process_number)))
+
+
+async def reset(url: str):
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[ChatMessage.__table__])
+        await conn.execute(delete(ChatMessage).where(ChatMessage.user_id >= BENCH_USER_ID, ChatMessage.model == MODEL))
+    await engine.dispose()
+
+
+async def check(args) -> dict:
+    engine = create_async_engine(args.url)
+    expected = args.processes * args.turns
+    async with engine.connect() as conn:
+        query = select(ChatMessage.user_id, func.count(), func.min(ChatMessage.seq), func.max(ChatMessage.seq)).where(
+            ChatMessage.user_id >= BENCH_USER_ID, ChatMessage.model == MODEL
+        ).group_by(ChatMessage.user_id)
+        rows = (await conn.execute(query)).all()
+    await engine.dispose()
+
+    counts = {user_id: count for user_id, count, _, _ in rows}
+    broken = sum(1 for _, count, low, high in rows if (low, high) != (1, count))
+    return {
+        'expected_turns': expected * args.users,
+        'stored_turns': sum(counts.values()),
+        'lost_turns': sum(expected - counts.get(BENCH_USER_ID + user, 0) for user in range(args.users)),
+        'users_with_gaps': broken,
+    }
+
+
+def main():
+    load_dotenv(find_dotenv())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.getenv('DB_URL'))
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=50)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--pool-size', type=int, default=20)
+    parser.add_argument('--backend', default=history_locks.backend, choices=['local', 'postgres'])
+    parser.add_argument('--unlocked', action='store_true')
+    args = parser.parse_args()
+
+    asyncio.run(reset(args.url))
+    if args.processes == 1:
+        runs = [asyncio.run(append_all(args, 0))]
+    else:
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        processes = [context.Process(target=run_process, args=(args, number, results))
+                     for number in range(args.processes)]
+        for process in processes:
+            process.start()
+        runs = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    result = asyncio.run(check(args))
+    result['failed_appends'] = sum(run['failed'] for run in runs)
+    result['seconds'] = max(run['seconds'] for run in runs)
+    result['locks_left'] = sum(run['locks_left'] for run in runs)
+    asyncio.run(reset(args.url))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import asyncio
+import hashlib
+import os
+import weakref
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# local - замки только внутри процесса; postgres - дополнительно advisory lock в транзакции сессии,
+# нужен, когда историю пишут несколько процессов бота
+HISTORY_LOCK_BACKEND = os.getenv('HISTORY_LOCK_BACKEND', 'local')
+
+
+class KeyedLock:
+    # Замок на ключ. Словарь слабый: замок живёт, пока его держат или ждут, потом удаляется сам,
+    # поэтому число замков не растёт вместе с числом пользователей
+    def __init__(self, namespace: str, backend: str = HISTORY_LOCK_BACKEND):
+        self.namespace = namespace
+        self.backend = backend
+        self.locks: weakref.WeakValueDictionary[Hashable, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    def _db_key(self, key: Hashable) -> int:
+        # bigint для pg_advisory_xact_lock, одинаковый во всех процессах (hash() у строк случайный)
+        digest = hashlib.blake2b(f'{self.namespace}:{key}'.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable, session: AsyncSession | None = None):
+        """Advisory lock живёт до конца транзакции session, поэтому внутри должен быть её commit"""
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = asyncio.Lock()
+        async with lock:
+            if self.backend == 'postgres' and session is not None:
+                # text(), а не select(): LazySession закрывает транзакции только с чтением, а вместе с ней и замок
+                await session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': self._db_key(key)})
+            yield
+
+    def __len__(self):
+        return len(self.locks)
+
+
+history_locks = KeyedLock('chat_history')
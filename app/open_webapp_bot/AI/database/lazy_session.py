@@ -0,0 +1,55 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+def is_read(statement) -> bool:
+    # SELECT без FOR UPDATE; text() и DML считаются записью
+    return getattr(statement, 'is_select', False) and getattr(statement, '_for_update_arg', None) is None
+
+
+class LazySession(AsyncSession):
+    # Сессия обработчика, которая не держит соединение из пула между запросами.
+    # AsyncSession берёт соединение при первом запросе и отдаёт его только на commit/rollback/close,
+    # поэтому после orm_get_balance или чтения истории соединение висело бы всё время ответа модели.
+    # Здесь транзакция, в которой были только чтения, закрывается сразу после запроса, а пишущая
+    # транзакция живёт как обычно до commit в orm_* функции.
+    # Работает только с expire_on_commit=False: иначе commit сбросит загруженные объекты.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writing = False
+        self.released = 0
+
+    def _track(self, statement):
+        # запись - это DML/text() или несохранённые объекты, которые autoflush запишет перед запросом
+        if not is_read(statement) or self.new or self.dirty or self.deleted:
+            self.writing = True
+
+    async def _release(self):
+        if self.writing or self.in_nested_transaction() or not self.in_transaction():
+            return
+        # в транзакции только чтения: commit ничего не пишет и возвращает соединение в пул
+        await self.commit()
+        self.released += 1
+
+    async def execute(self, statement, *args, **kwargs):
+        self._track(statement)
+        result = await super().execute(statement, *args, **kwargs)
+        await self._release()
+        return result
+
+    async def scalar(self, statement, *args, **kwargs):
+        self._track(statement)
+        result = await super().scalar(statement, *args, **kwargs)
+        await self._release()
+        return result
+
+    async def commit(self):
+        await super().commit()
+        self.writing = False
+
+    async def rollback(self):
+        await super().rollback()
+        self.writing = False
+
+    async def close(self):
+        await super().close()
+        self.writing = False
@@ -0,0 +1,100 @@
+import base64
+import hashlib
+
+from sqlalchemy import text, bindparam, BIGINT
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from app.open_webapp_bot.AI.database.blob_store import put_blob, make_image_ref
+
+# Перенос историй диалогов из JSONB колонок таблицы user в таблицу chat_message
+HISTORY_COLUMNS = {
+    'gemini_chat_history': 'gemini',
+    'perplexity_chat_history': 'perplexity',
+    'deep_research_chat_history': 'sonar_deep',
+    'gpt_chat_history': 'gpt',
+}
+
+
+async def migrate_chat_histories(engine: AsyncEngine):
+    # Переносим только непустые массивы и сразу их очищаем, поэтому повторный запуск ничего не сломает
+    async with engine.begin() as conn:
+        for column, model in HISTORY_COLUMNS.items():
+            await conn.execute(text(f'''
+                INSERT INTO chat_message (user_id, model, seq, role, content, created, updated)
+                SELECT u.user_id,
+                       :model,
+                       COALESCE((SELECT MAX(m.seq) FROM chat_message m
+                                 WHERE m.user_id = u.user_id AND m.model = :model), 0) + e.ord,
+                       COALESCE(e.msg ->> 'role', 'user'),
+                       e.msg -> 'content',
+                       now(),
+                       now()
+                FROM "user" u
+                CROSS JOIN LATERAL jsonb_array_elements(u.{column}) WITH ORDINALITY AS e(msg, ord)
+                WHERE jsonb_typeof(u.{column}) = 'array' AND jsonb_array_length(u.{column}) > 0
+            '''), {'model': model})
+
+            await conn.execute(text(f'''
+                UPDATE "user" SET {column} = '[]'::jsonb
+                WHERE jsonb_typeof({column}) = 'array' AND jsonb_array_length({column}) > 0
+            '''))
+
+
+async def migrate_promo_redemptions(engine: AsyncEngine):
+    # used_by из promo_code переносится в promo_redemption и очищается, повторный запуск ничего не сломает
+    async with engine.begin() as conn:
+        await conn.execute(text('''
+            INSERT INTO promo_redemption (code, user_id, created, updated)
+            SELECT p.code, e.user_id::bigint, now(), now()
+            FROM promo_code p
+            CROSS JOIN LATERAL jsonb_array_elements_text(p.used_by) AS e(user_id)
+            WHERE jsonb_typeof(p.used_by) = 'array' AND jsonb_array_length(p.used_by) > 0
+            ON CONFLICT (code, user_id) DO NOTHING
+        '''))
+
+        await conn.execute(text('''
+            UPDATE promo_code SET used_by = '[]'::jsonb
+            WHERE jsonb_typeof(used_by) = 'array' AND jsonb_array_length(used_by) > 0
+        '''))
+
+
+async def migrate_inline_images(engine: AsyncEngine, batch: int = 100):
+    # data URI картинок в сообщениях chat_message, сохранённых до хранилища блобов, переносятся на диск,
+    # в истории остаются ссылки blob:<sha256>. Изменённые сообщения под условие больше не подходят,
+    # поэтому повторный запуск ничего не сломает
+    select_query = text('''
+        SELECT id, content FROM chat_message
+        WHERE id > :last_id
+          AND jsonb_path_exists(content, '$[*] ? (@.type == "image_url" && @.image_url.url starts with "data:")')
+        ORDER BY id
+        LIMIT :batch
+    ''').columns(id=BIGINT, content=JSONB)
+    update_query = text('UPDATE chat_message SET content = :content, updated = now() WHERE id = :id').bindparams(
+        bindparam('content', type_=JSONB))
+
+    last_id = 0
+    while True:
+        async with engine.begin() as conn:
+            rows = (await conn.execute(select_query, {'last_id': last_id, 'batch': batch})).all()
+            for message_id, content in rows:
+                content = [await _inline_image_to_ref(conn, part) for part in content]
+                await conn.execute(update_query, {'content': content, 'id': message_id})
+        if len(rows) < batch:
+            return
+        last_id = rows[-1][0]
+
+
+async def _inline_image_to_ref(conn, part):
+    url = part.get('image_url', {}).get('url', '') if isinstance(part, dict) and part.get('type') == 'image_url' else ''
+    if not url.startswith('data:') or ',' not in url:
+        return part
+    data = base64.b64decode(url.split(',', 1)[1])
+    digest = hashlib.sha256(data).hexdigest()
+    # как в orm_save_blob: сначала строка image_blob, потом файл
+    await conn.execute(text('''
+        INSERT INTO image_blob (sha256, size, refs, created, updated) VALUES (:digest, :size, 1, now(), now())
+        ON CONFLICT (sha256) DO UPDATE SET refs = image_blob.refs + 1
+    '''), {'digest': digest, 'size': len(data)})
+    await put_blob(data)
+    return {'type': 'image_url', 'image_url': {'url': make_image_ref(digest)}}
@@ -1,4 +1,4 @@
-from sqlalchemy import DateTime, func, String, BIGINT
+from sqlalchemy import DateTime, func, String, BIGINT, Index, Text, LargeBinary
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
@@ -16,10 +16,102 @@ class User(Base):
     last_name: Mapped[str] = mapped_column(String(150), nullable=True)
     username: Mapped[str] = mapped_column(String(150), nullable=True)
     tokens: Mapped[int] = mapped_column(nullable=False)
-    gemini_chat_history: Mapped[list] = mapped_column(JSONB, default=list)
-    perplexity_chat_history: Mapped[list] = mapped_column(JSONB, default=list)
-    deep_research_chat_history: Mapped[list] = mapped_column(JSONB, default=list)
-    gpt_chat_history: Mapped[list] = mapped_column(JSONB, default=list)
+    # старые истории диалогов, теперь хранятся в chat_message (см. migrations.py).
+    # select(User) их не загружает, а обращение к ним у загруженного объекта - ошибка, а не скрытый запрос
+    gemini_chat_history: Mapped[list] = mapped_column(JSONB, default=list, deferred=True, deferred_raiseload=True)
+    perplexity_chat_history: Mapped[list] = mapped_column(JSONB, default=list, deferred=True, deferred_raiseload=True)
+    deep_research_chat_history: Mapped[list] = mapped_column(JSONB, default=list, deferred=True,
+                                                             deferred_raiseload=True)
+    gpt_chat_history: Mapped[list] = mapped_column(JSONB, default=list, deferred=True, deferred_raiseload=True)
+
+class ChatMessage(Base):
+    __tablename__ = 'chat_message'
+    __table_args__ = (
+        Index('ix_chat_message_user_model_seq', 'user_id', 'model', 'seq', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(BIGINT, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    model: Mapped[str] = mapped_column(String(30), nullable=False)
+    seq: Mapped[int] = mapped_column(nullable=False)
+    role: Mapped[str] = mapped_column(String(20), nullable=False)
+    content: Mapped[dict | list | str] = mapped_column(JSONB, nullable=True)
+
+class ChatSummary(Base):
+    __tablename__ = 'chat_summary'
+    __table_args__ = (
+        Index('ix_chat_summary_user_model', 'user_id', 'model', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(BIGINT, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    model: Mapped[str] = mapped_column(String(30), nullable=False)
+    # сколько первых сообщений истории уже свёрнуто в резюме
+    upto: Mapped[int] = mapped_column(nullable=False, default=0)
+    content: Mapped[str] = mapped_column(Text, nullable=False)
+
+class ImageBlob(Base):
+    __tablename__ = 'image_blob'
+
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    size: Mapped[int] = mapped_column(nullable=False)
+    refs: Mapped[int] = mapped_column(nullable=False, default=1)
+
+class VideoGeneration(Base):
+    __tablename__ = 'video_generation'
+    __table_args__ = (
+        Index('ix_video_generation_status_poll', 'status', 'next_poll_at'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    generation_id: Mapped[str] = mapped_column(String(150), unique=True)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    chat_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    # ключ тарифа в rate, списывается после готовности видео
+    model: Mapped[str] = mapped_column(String(30), nullable=False)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default='pending')
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    next_poll_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+    video_url: Mapped[str] = mapped_column(Text, nullable=True)
+
+class ImageJob(Base):
+    __tablename__ = 'image_job'
+    __table_args__ = (
+        Index('ix_image_job_status_run', 'status', 'next_run_at'),
+    )
+
+    id: Mapped[int] = mapped_column(BIGINT, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    chat_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+    # ключ тарифа в rate
+    model: Mapped[str] = mapped_column(String(30), nullable=False)
+    prompt: Mapped[str] = mapped_column(Text, nullable=False)
+    # sha256 входных картинок в хранилище блобов
+    images: Mapped[list] = mapped_column(JSONB, default=list)
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default='queued')
+    attempts: Mapped[int] = mapped_column(nullable=False, default=0)
+    next_run_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+    result: Mapped[str] = mapped_column(String(64), nullable=True)
+    billed: Mapped[bool] = mapped_column(nullable=False, default=False)
+    delivered: Mapped[bool] = mapped_column(nullable=False, default=False)
+
+class FsmState(Base):
+    __tablename__ = 'fsm_state'
+    __table_args__ = (
+        Index('ix_fsm_state_updated', 'updated'),
+    )
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSONB, default=dict)
+
+class FsmBlob(Base):
+    # большие значения из данных состояния (картинки), в fsm_state на них лежат ссылки
+    __tablename__ = 'fsm_blob'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
 
 class PromoCode(Base):
     __tablename__ = 'promo_code'
@@ -27,9 +119,21 @@ class PromoCode(Base):
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     code: Mapped[str] = mapped_column(String(150), unique=True)
     value: Mapped[int] = mapped_column(nullable=False)
-    used_by: Mapped[list] = mapped_column(JSONB, default=list)
+    # старый список использовавших, теперь это promo_redemption (см. migrations.py)
+    used_by: Mapped[list] = mapped_column(JSONB, default=list, deferred=True, deferred_raiseload=True)
     date_end: Mapped[DateTime] = mapped_column(DateTime,)
 
+class PromoRedemption(Base):
+    # одна строка на активацию промокода пользователем, повторная активация упирается в уникальный индекс
+    __tablename__ = 'promo_redemption'
+    __table_args__ = (
+        Index('ix_promo_redemption_code_user', 'code', 'user_id', unique=True),
+    )
+
+    id: Mapped[int] = mapped_column(BIGINT, primary_key=True, autoincrement=True)
+    code: Mapped[str] = mapped_column(String(150), nullable=False)
+    user_id: Mapped[int] = mapped_column(BIGINT, nullable=False)
+
 
 
 
@@ -1,9 +1,16 @@
-from asyncio import Lock
+import base64
+import hashlib
+from datetime import datetime, timedelta
 
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import update, select, delete
+from sqlalchemy import update, select, delete, func
 
-from app.open_webapp_bot.AI.database.models import User, PromoCode
+from app.open_webapp_bot.AI.database.blob_store import put_blob, make_image_ref, image_refs, delete_blobs
+from app.open_webapp_bot.AI.database.keyed_lock import history_locks
+from app.open_webapp_bot.AI.database.models import User, PromoCode, ChatMessage, ImageBlob, ChatSummary, \
+    VideoGeneration, ImageJob, PromoRedemption
+from app.open_webapp_bot.AI.database.user_cache import user_cache
 
 
 async def orm_add_user(session: AsyncSession, data: dict):
@@ -19,7 +26,33 @@ async def orm_add_user(session: AsyncSession, data: dict):
     )
     session.add(user)
     await session.commit()
+    user_cache.invalidate(data['user_id'])
+
+async def orm_upsert_user_profile(session: AsyncSession, user_id: int, first_name: str, last_name: str,
+                                  username: str, tokens: int):
+    # Новый пользователь получает tokens, у существующего одним запросом обновляются все три имени
+    query = insert(User).values(
+        user_id=user_id, first_name=first_name, last_name=last_name, username=username, tokens=tokens,
+        gemini_chat_history=[], perplexity_chat_history=[], deep_research_chat_history=[], gpt_chat_history=[]
+    ).on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={'first_name': first_name, 'last_name': last_name, 'username': username, 'updated': func.now()}
+    )
+    await session.execute(query)
+    await session.commit()
+    user_cache.invalidate(user_id)
 
+async def orm_get_user_profile(session: AsyncSession, user_id: int):
+    # user_id, имена и tokens через кэш (user_cache.py), None - пользователя нет
+    profile = user_cache.get(user_id)
+    if profile is None:
+        generation = user_cache.generation
+        query = select(User.user_id, User.first_name, User.last_name, User.username, User.tokens).where(
+            User.user_id == user_id)
+        profile = (await session.execute(query)).first()
+        if profile is not None:
+            user_cache.put(user_id, profile, generation)
+    return profile
 
 
 async def orm_get_users(session:AsyncSession):
@@ -28,174 +61,313 @@ async def orm_get_users(session:AsyncSession):
     return result.scalars().all()
 
 async def orm_get_user(session:AsyncSession, user_id: int):
+    # истории диалогов у User отложенные и сюда не попадают
     query = select(User).where(User.user_id == user_id)
     result = await session.execute(query)
     return result.scalar()
 
 
 async def orm_clear_user_histories(session: AsyncSession):
-    query = update(User).values(gemini_chat_history=[],
-        perplexity_chat_history=[],
-        deep_research_chat_history=[]
-    )
+    condition = ChatMessage.model.in_(['gemini', 'perplexity', 'sonar_deep'])
+    refs = await orm_get_image_refs(session, condition)
+    query = delete(ChatMessage).where(condition)
     await session.execute(query)
-    await session.commit()
+    await session.execute(delete(ChatSummary).where(ChatSummary.model.in_(['gemini', 'perplexity', 'sonar_deep'])))
+    await orm_release_images(session, refs)
 
 
 async def orm_get_balance(session: AsyncSession, user_id: int):
-    query = select(User).where(User.user_id == user_id)
-    result = await session.execute(query)
+    profile = await orm_get_user_profile(session, user_id)
+    return profile.tokens if profile else None
 
-    if result:
-        return result.scalar().tokens
+def _reserve_query(user_id: int, cost: int):
+    # Проверка и списание одним запросом: параллельные запросы не уведут баланс в минус
+    return update(User).where(User.user_id == user_id, User.tokens >= cost).values(
+        tokens=User.tokens - cost).returning(User.tokens)
+
+async def orm_reserve_tokens(session: AsyncSession, user_id: int, cost: int) -> int | None:
+    # None - токенов не хватает, иначе остаток после списания
+    result = await session.execute(_reserve_query(user_id, cost))
+    await session.commit()
+    user_cache.invalidate(user_id)
+    return result.scalar()
 
 
 async def orm_update_balance(session: AsyncSession, user_id: int, tokens: int):
     query = update(User).where(User.user_id == user_id).values(tokens=User.tokens + tokens)
     await session.execute(query)
     await session.commit()
+    user_cache.invalidate(user_id)
 
 async def orm_update_first_name(session: AsyncSession, user_id: int, first_name: str):
     query = update(User).where(User.user_id == user_id).values(first_name=first_name)
     await session.execute(query)
     await session.commit()
+    user_cache.invalidate(user_id)
 
 async def orm_update_last_name(session: AsyncSession, user_id: int, last_name: str):
     query = update(User).where(User.user_id == user_id).values(last_name=last_name)
     await session.execute(query)
     await session.commit()
+    user_cache.invalidate(user_id)
 
 async def orm_update_user_name(session: AsyncSession, user_id: int, user_name: str):
     query = update(User).where(User.user_id == user_id).values(username=user_name)
     await session.execute(query)
     await session.commit()
+    user_cache.invalidate(user_id)
 
 
 async def orm_get_user_id(session: AsyncSession, user_name: str,):
-    query = select(User).where(User.username == user_name)
+    query = select(User.user_id).where(User.username == user_name).limit(1)
     result = await session.execute(query)
-    ret = result.scalar()
-    if ret:
-        return ret.user_id
+    return result.scalar()
 
 
-async def orm_get_chat_history(session: AsyncSession, user_id: int, model: str):
-    res = None
-    query = select(User).where(User.user_id == user_id)
+async def orm_get_chat_history(session: AsyncSession, user_id: int, model: str, after: int = 0):
+    query = select(ChatMessage.role, ChatMessage.content).where(
+        ChatMessage.user_id == user_id, ChatMessage.model == model, ChatMessage.seq > after
+    ).order_by(ChatMessage.seq)
     result = await session.execute(query)
 
-    if model == 'gemini':
-        res = result.scalar().gemini_chat_history
-    elif model == 'perplexity':
-        res = result.scalar().perplexity_chat_history
-    elif model == 'sonar_deep':
-        res = result.scalar().deep_research_chat_history
-    elif model == 'gpt':
-        res = result.scalar().gpt_chat_history
+    return [{'role': role, 'content': content} for role, content in result.all()]
 
-    return res
 
-########### gemini ###########
+async def orm_add_chat_messages(session: AsyncSession, chat: list, user_id: int, model: str):
+    # Добавляем сообщения в конец истории, старые строки не трогаем
+    query = select(func.coalesce(func.max(ChatMessage.seq), 0)).where(
+        ChatMessage.user_id == user_id, ChatMessage.model == model
+    )
+    last_seq = (await session.execute(query)).scalar()
 
-gem_locks = {}
+    session.add_all([
+        ChatMessage(user_id=user_id, model=model, seq=last_seq + i, role=message['role'], content=message['content'])
+        for i, message in enumerate(chat, start=1)
+    ])
+    await session.commit()
 
-async def get_gem_lock(user_id: int) -> Lock:
-    if user_id not in perp_locks:
-        perp_locks[user_id] = Lock()
-    return perp_locks[user_id]
 
-async def orm_update_gemini_chat_history(session: AsyncSession, chat, user_id: int):
-    query = update(User).where(User.user_id == user_id).values(gemini_chat_history=User.gemini_chat_history + chat)
+async def orm_delete_chat_messages(session: AsyncSession, user_id: int, model: str):
+    condition = (ChatMessage.user_id == user_id) & (ChatMessage.model == model)
+    refs = await orm_get_image_refs(session, condition)
+    query = delete(ChatMessage).where(condition)
+    await session.execute(query)
+    await session.execute(delete(ChatSummary).where(ChatSummary.user_id == user_id, ChatSummary.model == model))
+    await orm_release_images(session, refs)
+
+
+async def orm_get_chat_summary(session: AsyncSession, user_id: int, model: str):
+    query = select(ChatSummary.upto, ChatSummary.content).where(
+        ChatSummary.user_id == user_id, ChatSummary.model == model
+    )
+    result = (await session.execute(query)).first()
+    if result:
+        return result.upto, result.content
+    return 0, None
+
+
+async def orm_set_chat_summary(session: AsyncSession, user_id: int, model: str, upto: int, content: str):
+    query = insert(ChatSummary).values(user_id=user_id, model=model, upto=upto, content=content).on_conflict_do_update(
+        index_elements=[ChatSummary.user_id, ChatSummary.model], set_={'upto': upto, 'content': content}
+    )
     await session.execute(query)
     await session.commit()
 
-async def orm_delete_gemini_chat_history(session: AsyncSession, user_id: int):
-    query = update(User).where(User.user_id == user_id).values(gemini_chat_history=[])
+########### images ###########
+
+async def orm_save_blob(session: AsyncSession, data: bytes) -> str:
+    # Файл пишется на диск один раз, повторное сохранение только увеличивает счётчик ссылок.
+    # Сначала строка image_blob: её блокировка до commit не даёт orm_release_images удалить файл,
+    # а если удаление уже идёт, upsert дождётся его конца и файл будет записан заново
+    digest = hashlib.sha256(data).hexdigest()
+    query = insert(ImageBlob).values(sha256=digest, size=len(data), refs=1).on_conflict_do_update(
+        index_elements=[ImageBlob.sha256], set_={'refs': ImageBlob.refs + 1}
+    )
     await session.execute(query)
+    await put_blob(data)
+    return digest
+
+async def orm_save_image(session: AsyncSession, b64_image: str) -> str:
+    # Картинка кладётся на диск один раз, в истории остаётся только ссылка blob:<sha256>
+    digest = await orm_save_blob(session, base64.b64decode(b64_image))
+    return make_image_ref(digest)
+
+async def orm_get_image_refs(session: AsyncSession, condition) -> list[str]:
+    query = select(ChatMessage.content).where(condition, func.jsonb_typeof(ChatMessage.content) == 'array')
+    result = await session.execute(query)
+    refs = []
+    for content in result.scalars():
+        refs += image_refs(content)
+    return refs
+
+async def orm_release_images(session: AsyncSession, refs: list[str]):
+    # Коммитит текущую транзакцию и удаляет файлы, на которые больше никто не ссылается.
+    # Файлы удаляются до commit, пока строки image_blob заблокированы (см. orm_save_blob)
+    unused = []
+    for digest in set(refs):
+        query = update(ImageBlob).where(ImageBlob.sha256 == digest).values(
+            refs=ImageBlob.refs - refs.count(digest)
+        ).returning(ImageBlob.refs)
+        left = (await session.execute(query)).scalar()
+        if left is not None and left <= 0:
+            unused.append(digest)
+
+    if unused:
+        await session.execute(delete(ImageBlob).where(ImageBlob.sha256.in_(unused), ImageBlob.refs <= 0))
+        await delete_blobs(unused)
     await session.commit()
 
-########### perplexity ###########
+########### gemini ###########
 
-# Глобальный словарь замков
-perp_locks = {}
+async def orm_update_gemini_chat_history(session: AsyncSession, chat, user_id: int):
+    async with history_locks.hold(('gemini', user_id), session):
+        await orm_add_chat_messages(session, chat, user_id, 'gemini')
 
-async def get_perp_lock(user_id: int) -> Lock:
-    if user_id not in perp_locks:
-        perp_locks[user_id] = Lock()
-    return perp_locks[user_id]
+async def orm_delete_gemini_chat_history(session: AsyncSession, user_id: int):
+    async with history_locks.hold(('gemini', user_id), session):
+        await orm_delete_chat_messages(session, user_id, 'gemini')
+
+########### perplexity ###########
 
 async def orm_update_perplexity_chat_history(session: AsyncSession, chat, user_id: int):
-    lock = await get_perp_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(perplexity_chat_history=User.perplexity_chat_history + chat)
-        await session.execute(query)
-        await session.commit()
+    async with history_locks.hold(('perplexity', user_id), session):
+        await orm_add_chat_messages(session, chat, user_id, 'perplexity')
 
 async def orm_delete_perplexity_chat_history(session: AsyncSession, user_id: int):
-    lock = await get_perp_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(perplexity_chat_history=[])
-        await session.execute(query)
-        await session.commit()
+    async with history_locks.hold(('perplexity', user_id), session):
+        await orm_delete_chat_messages(session, user_id, 'perplexity')
 
 ########### sonar deep ###########
 
-# Глобальный словарь замков
-deep_locks = {}
-
-async def get_deep_lock(user_id: int) -> Lock:
-    if user_id not in deep_locks:
-        deep_locks[user_id] = Lock()
-    return deep_locks[user_id]
-
-# Пример обёртки обновления истории с блокировкой
 async def orm_update_sonar_deep_chat_history(session: AsyncSession, chat, user_id: int):
-    lock = await get_deep_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(
-            deep_research_chat_history=User.deep_research_chat_history + chat
-        )
-        await session.execute(query)
-        await session.commit()
+    async with history_locks.hold(('sonar_deep', user_id), session):
+        await orm_add_chat_messages(session, chat, user_id, 'sonar_deep')
 
 async def orm_delete_sonar_deep_chat_history(session: AsyncSession, user_id: int):
-    lock = await get_deep_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(
-            deep_research_chat_history=[]
-        )
-        await session.execute(query)
-        await session.commit()
+    async with history_locks.hold(('sonar_deep', user_id), session):
+        await orm_delete_chat_messages(session, user_id, 'sonar_deep')
 
 ########### gpt-5 ###########
 
+async def orm_update_gpt_chat_history(session: AsyncSession, chat, user_id: int):
+    async with history_locks.hold(('gpt', user_id), session):
+        await orm_add_chat_messages(session, chat, user_id, 'gpt')
 
-# Глобальный словарь замков
-gpt_locks = {}
+async def orm_delete_gpt_chat_history(session: AsyncSession, user_id: int):
+    async with history_locks.hold(('gpt', user_id), session):
+        await orm_delete_chat_messages(session, user_id, 'gpt')
 
-async def get_gpt_lock(user_id: int) -> Lock:
-    if user_id not in gpt_locks:
-        gpt_locks[user_id] = Lock()
-    return gpt_locks[user_id]
+########### video ###########
 
-# Пример обёртки обновления истории с блокировкой
-async def orm_update_gpt_chat_history(session: AsyncSession, chat, user_id: int):
-    lock = await get_deep_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(
-            gpt_chat_history=User.gpt_chat_history + chat
-        )
-        await session.execute(query)
-        await session.commit()
+async def orm_add_video_generation(session: AsyncSession, generation_id: str, user_id: int, chat_id: int, model: str,
+                                   first_poll: float):
+    generation = VideoGeneration(generation_id=generation_id, user_id=user_id, chat_id=chat_id, model=model,
+                                 next_poll_at=datetime.now() + timedelta(seconds=first_poll))
+    session.add(generation)
+    await session.commit()
 
-async def orm_delete_gpt_chat_history(session: AsyncSession, user_id: int):
-    lock = await get_deep_lock(user_id)
-    async with lock:
-        query = update(User).where(User.user_id == user_id).values(
-            gpt_chat_history=[]
-        )
-        await session.execute(query)
-        await session.commit()
+async def orm_claim_video_generations(session: AsyncSession, limit: int, lease: float):
+    # Берём генерации, которые пора проверить, и откладываем их на lease секунд,
+    # чтобы другой процесс бота не опрашивал их одновременно
+    now = datetime.now()
+    query = select(VideoGeneration).where(
+        VideoGeneration.status == 'pending', VideoGeneration.next_poll_at <= now
+    ).order_by(VideoGeneration.next_poll_at).limit(limit).with_for_update(skip_locked=True)
+    generations = (await session.execute(query)).scalars().all()
+    for generation in generations:
+        generation.next_poll_at = now + timedelta(seconds=lease)
+    await session.commit()
+    return generations
+
+async def orm_update_video_generation(session: AsyncSession, generation_id: str, **values):
+    query = update(VideoGeneration).where(VideoGeneration.generation_id == generation_id).values(**values)
+    await session.execute(query)
+    await session.commit()
+
+########### image jobs ###########
+
+async def orm_add_image_job(session: AsyncSession, user_id: int, chat_id: int, model: str, prompt: str,
+                            images: list[bytes], cost: int) -> int | None:
+    # Списание стоимости и создание задачи в одной транзакции, None - токенов не хватает.
+    # Если генерация так и не удастся, токены вернёт orm_refund_image_job
+    if (await session.execute(_reserve_query(user_id, cost))).scalar() is None:
+        await session.rollback()
+        return None
+    digests = [await orm_save_blob(session, image) for image in images]
+    job = ImageJob(user_id=user_id, chat_id=chat_id, model=model, prompt=prompt, images=digests, billed=True)
+    session.add(job)
+    await session.commit()
+    user_cache.invalidate(user_id)
+    return job.id
+
+async def orm_get_image_job(session: AsyncSession, job_id: int):
+    query = select(ImageJob).where(ImageJob.id == job_id)
+    result = await session.execute(query)
+    return result.scalar()
+
+async def orm_claim_image_jobs(session: AsyncSession, limit: int, lease: float):
+    # Как и для видео: задача закрепляется за воркером на lease секунд, после падения процесса
+    # её подхватит любой другой воркер
+    now = datetime.now()
+    query = select(ImageJob).where(
+        ImageJob.status == 'queued', ImageJob.next_run_at <= now
+    ).order_by(ImageJob.next_run_at).limit(limit).with_for_update(skip_locked=True)
+    jobs = (await session.execute(query)).scalars().all()
+    for job in jobs:
+        job.next_run_at = now + timedelta(seconds=lease)
+    await session.commit()
+    return jobs
+
+async def orm_release_image_jobs(session: AsyncSession, job_ids: list[int]):
+    # Снимает закрепление с незавершённых задач остановленного воркера, их сразу подхватит другой
+    query = update(ImageJob).where(ImageJob.id.in_(job_ids), ImageJob.status == 'queued').values(
+        next_run_at=datetime.now())
+    await session.execute(query)
+    await session.commit()
+
+async def orm_update_image_job(session: AsyncSession, job_id: int, **values):
+    query = update(ImageJob).where(ImageJob.id == job_id).values(**values)
+    await session.execute(query)
+    await session.commit()
+
+async def orm_bill_image_job(session: AsyncSession, job_id: int, cost: int) -> bool:
+    # Отметка billed и списание в одной транзакции: повтор задачи не спишет токены второй раз
+    query = update(ImageJob).where(ImageJob.id == job_id, ImageJob.billed.is_(False)).values(
+        billed=True).returning(ImageJob.user_id)
+    user_id = (await session.execute(query)).scalar()
+    if user_id is None:
+        await session.rollback()
+        return False
+    await session.execute(update(User).where(User.user_id == user_id).values(tokens=User.tokens - cost))
+    await session.commit()
+    user_cache.invalidate(user_id)
+    return True
+
+async def orm_refund_image_job(session: AsyncSession, job_id: int, cost: int) -> bool:
+    # Обратная операция к orm_bill_image_job, вернуть токены можно только один раз
+    query = update(ImageJob).where(ImageJob.id == job_id, ImageJob.billed.is_(True)).values(
+        billed=False).returning(ImageJob.user_id)
+    user_id = (await session.execute(query)).scalar()
+    if user_id is None:
+        await session.rollback()
+        return False
+    await session.execute(update(User).where(User.user_id == user_id).values(tokens=User.tokens + cost))
+    await session.commit()
+    user_cache.invalidate(user_id)
+    return True
+
+async def orm_delete_old_image_jobs(session: AsyncSession, before: datetime):
+    query = select(ImageJob).where(ImageJob.status.in_(('done', 'failed')), ImageJob.updated < before)
+    jobs = (await session.execute(query)).scalars().all()
+    if not jobs:
+        return
+    refs = []
+    for job in jobs:
+        refs += job.images
+        if job.result:
+            refs.append(job.result)
+    await session.execute(delete(ImageJob).where(ImageJob.id.in_([job.id for job in jobs])))
+    await orm_release_images(session, refs)
 
 ###################################
 
@@ -219,14 +391,45 @@ async def orm_get_promo_code(session: AsyncSession, code: str):
 
     return result.scalar()
 
-async def orm_use_promo_code(session: AsyncSession, code: str, user_id: int):
-    query = update(PromoCode).where(PromoCode.code == code).values(used_by=PromoCode.used_by + [user_id])
-    await session.execute(query)
+async def orm_redeem_promo_code(session: AsyncSession, code: str, user_id: int, value: int) -> bool:
+    # Отметка об активации и начисление в одной транзакции. False - пользователь уже активировал этот код,
+    # в том числе если два запроса пришли одновременно
+    query = insert(PromoRedemption).values(code=code, user_id=user_id).on_conflict_do_nothing(
+        index_elements=[PromoRedemption.code, PromoRedemption.user_id]
+    ).returning(PromoRedemption.id)
+    if (await session.execute(query)).scalar() is None:
+        await session.rollback()
+        return False
+    await session.execute(update(User).where(User.user_id == user_id).values(tokens=User.tokens + value))
     await session.commit()
+    user_cache.invalidate(user_id)
+    return True
+
+async def orm_get_promo_report(session: AsyncSession, users_per_code: int | None = None):
+    # Все коды с активировавшими их пользователями одним запросом: строки
+    # (code, value, date_end, user_id, username, used), у кода без активаций user_id = None, used = 0.
+    # users_per_code - сколько первых активаций каждого кода вернуть, used - сколько их всего
+    redemptions = select(
+        PromoRedemption.id, PromoRedemption.code, PromoRedemption.user_id,
+        func.row_number().over(partition_by=PromoRedemption.code, order_by=PromoRedemption.id).label('n'),
+        func.count().over(partition_by=PromoRedemption.code).label('used')
+    ).subquery()
+    condition = redemptions.c.code == PromoCode.code
+    if users_per_code is not None:
+        condition &= redemptions.c.n <= users_per_code
+    query = select(
+        PromoCode.code, PromoCode.value, PromoCode.date_end, redemptions.c.user_id, User.username,
+        func.coalesce(redemptions.c.used, 0)
+    ).outerjoin(redemptions, condition).outerjoin(User, User.user_id == redemptions.c.user_id).order_by(
+        PromoCode.code, redemptions.c.id
+    )
+    result = await session.execute(query)
+    return result.all()
 
 async def orm_delete_promo_code(session: AsyncSession, code: str):
     query = delete(PromoCode).where(PromoCode.code == code)
     await session.execute(query)
+    await session.execute(delete(PromoRedemption).where(PromoRedemption.code == code))
     await session.commit()
 
 
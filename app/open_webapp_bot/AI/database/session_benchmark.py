@@ -0,0 +1,127 @@
+"""Занятость пула соединений при долгих запросах к моделям: сессия на весь апдейт против LazySession.
+
+    python -m app.open_webapp_bot.AI.database.session_benchmark --requests 200 --pool-size 10 --latency 5
+
+Каждый запрос ведёт себя как обработчик текста: orm_get_balance, ожидание ответа модели
+(--latency секунд, +-50%), orm_update_balance. Запросы стартуют одновременно, пул ограничен
+--pool-size соединениями без overflow. Раз в --sample секунд снимается число выданных соединений.
+База берётся из DB_URL (или --url), для прогона создаются и потом удаляются пользователи
+с user_id от BENCH_USER_ID.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from dotenv import load_dotenv, find_dotenv
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+
+from app.open_webapp_bot.AI.database.lazy_session import LazySession
+from app.open_webapp_bot.AI.database.models import Base, User
+from app.open_webapp_bot.AI.database.orm_query import orm_get_balance, orm_update_balance
+from app.open_webapp_bot.AI.database.user_cache import user_cache
+
+BENCH_USER_ID = 9_000_000_000_000
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def handle(session_pool: async_sessionmaker, user_id: int, latency: float) -> float:
+    start = time.perf_counter()
+    async with session_pool() as session:
+        if await orm_get_balance(session, user_id) > 0:
+            await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+            await orm_update_balance(session, user_id, -1)
+    return time.perf_counter() - start
+
+
+async def run_mode(engine, mode: str, args) -> dict:
+    session_pool = async_sessionmaker(bind=engine, class_=LazySession if mode == 'lazy' else AsyncSession,
+                                      expire_on_commit=False)
+    samples = []
+    stop = asyncio.Event()
+
+    async def sampler():
+        while not stop.is_set():
+            samples.append(engine.pool.checkedout())
+            await asyncio.sleep(args.sample)
+
+    sampler_task = asyncio.create_task(sampler())
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(handle(session_pool, BENCH_USER_ID + i % args.users, args.latency) for i in range(args.requests)),
+        return_exceptions=True
+    )
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await sampler_task
+
+    durations = [r for r in results if isinstance(r, float)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    return {
+        'mode': mode,
+        'seconds': elapsed,
+        'completed': len(durations),
+        'pool_timeouts': sum(1 for e in errors if isinstance(e, PoolTimeoutError)),
+        'errors': len(errors),
+        'pool_peak': max(samples, default=0),
+        'pool_mean': sum(samples) / len(samples) if samples else 0.0,
+        'p50_s': percentile(durations, 0.5),
+        'p95_s': percentile(durations, 0.95),
+    }
+
+
+async def create_bench_users(engine, count: int, tokens: int):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all, tables=[User.__table__])
+        await conn.execute(delete(User).where(User.user_id >= BENCH_USER_ID))
+        await conn.execute(insert(User), [
+            {'user_id': BENCH_USER_ID + i, 'tokens': tokens, 'gemini_chat_history': [],
+             'perplexity_chat_history': [], 'deep_research_chat_history': [], 'gpt_chat_history': []}
+            for i in range(count)
+        ])
+
+
+async def drop_bench_users(engine):
+    async with engine.begin() as conn:
+        await conn.execute(delete(User).where(User.user_id >= BENCH_USER_ID))
+
+
+async def run(args) -> list[dict]:
+    engine = create_async_engine(args.url, pool_size=args.pool_size, max_overflow=0, pool_timeout=args.pool_timeout)
+    await create_bench_users(engine, args.users, args.requests)
+    try:
+        return [await run_mode(engine, mode, args) for mode in args.modes]
+    finally:
+        await drop_bench_users(engine)
+        await engine.dispose()
+
+
+def main():
+    load_dotenv(find_dotenv())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default=os.getenv('DB_URL'))
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--pool-timeout', type=float, default=30)
+    parser.add_argument('--latency', type=float, default=5)
+    parser.add_argument('--sample', type=float, default=0.01)
+    parser.add_argument('--modes', nargs='+', default=['request', 'lazy'], choices=['request', 'lazy'])
+    args = parser.parse_args()
+    # меряем базу, а не кэш профилей
+    user_cache.ttl = 0
+    print(json.dumps(asyncio.run(run(args)), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
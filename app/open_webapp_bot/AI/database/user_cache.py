@@ -0,0 +1,62 @@
+import os
+import time
+from collections import OrderedDict
+
+# Короткий кэш профилей пользователей (id, имена, tokens) в памяти процесса.
+# Свои записи в user сбрасывают кэш сразу, записи других процессов видны не позже чем через USER_CACHE_TTL.
+# USER_CACHE_TTL=0 отключает кэш
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 30))
+USER_CACHE_ITEMS = int(os.getenv('USER_CACHE_ITEMS', 10000))
+
+
+class UserProfileCache:
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_items: int = USER_CACHE_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.items: OrderedDict[int, tuple[float, object]] = OrderedDict()
+        # растёт при каждом сбросе: чтение из базы, начатое до записи, не положит в кэш старое значение
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id: int):
+        item = self.items.get(user_id)
+        if item is None or item[0] <= time.monotonic():
+            if item is not None:
+                del self.items[user_id]
+            self.misses += 1
+            return None
+        self.items.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def put(self, user_id: int, profile, generation: int):
+        if self.ttl <= 0 or generation != self.generation:
+            return
+        self.items[user_id] = (time.monotonic() + self.ttl, profile)
+        self.items.move_to_end(user_id)
+        while len(self.items) > self.max_items:
+            self.items.popitem(last=False)
+
+    def invalidate(self, user_id: int | None = None):
+        # None - сбросить всё, если неизвестно, чьи записи изменились
+        self.generation += 1
+        self.invalidations += 1
+        if user_id is None:
+            self.items.clear()
+        else:
+            self.items.pop(user_id, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'items': len(self.items),
+            'invalidations': self.invalidations,
+        }
+
+
+user_cache = UserProfileCache()
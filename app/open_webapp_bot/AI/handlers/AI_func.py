@@ -1,30 +1,33 @@
 import asyncio
+import base64
 import os
 
 
 from aiogram import Router, F, types, Bot
-from aiogram.client.session import aiohttp
 from aiogram.enums import ParseMode
 from aiogram.filters import or_f
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import FSInputFile, BufferedInputFile
-from openai import BadRequestError
+from aiogram.types import FSInputFile
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.open_webapp_bot.AI.api_requests.deepseek import deepseek
-from app.open_webapp_bot.AI.api_requests.grok import grok_for_receipt
-from app.open_webapp_bot.AI.api_requests.nano_banana import nano_banana
-from app.open_webapp_bot.AI.api_requests.open_ai import gpt_5
-from app.open_webapp_bot.AI.api_requests.perplexity import perp_send_request
-from app.open_webapp_bot.AI.database.orm_query import orm_delete_gpt_chat_history, orm_get_user, orm_add_user, \
-    orm_update_user_name, orm_update_first_name, orm_update_last_name, orm_delete_perplexity_chat_history, \
-    orm_delete_gemini_chat_history
+from app.open_webapp_bot.AI.api_requests.deepseek import deepseek, deepseek_stream
+from app.open_webapp_bot.AI.api_requests.cache import CACHE_BILL_HITS
+from app.open_webapp_bot.AI.api_requests.grok import grok_for_receipt, cached_receipt
+from app.open_webapp_bot.AI.api_requests.open_ai import gpt_5, gpt_5_stream
+from app.open_webapp_bot.AI.api_requests.perplexity import perp_send_request, perp_stream_request
+from app.open_webapp_bot.AI.database.orm_query import orm_delete_gpt_chat_history, orm_get_user_profile, \
+    orm_upsert_user_profile, orm_delete_perplexity_chat_history, orm_delete_gemini_chat_history, orm_get_image_job
+from app.open_webapp_bot.AI.database.blob_store import get_blob
 
 from app.open_webapp_bot.AI.kbds.inline import get_callback_btns, kbd_tk
-from app.open_webapp_bot.AI.kbds.reply import main_kbd, text_kbd
+from app.open_webapp_bot.AI.kbds.reply import main_kbd, text_kbd, VIDEO_ENABLED
+from app.open_webapp_bot.AI.handlers.album_buffer import album_buffer
+from app.open_webapp_bot.AI.handlers.image_jobs import image_jobs
+from app.open_webapp_bot.AI.handlers.video_tracker import video_tracker
+from app.shared.chat_order import release_chat
 from app.open_webapp_bot.AI.handlers.processing import check_balance, send_typing_action, get_image_for_ai, \
-    send_long_text, use_model
+    send_long_text, reserve_tokens, refund_tokens, send_streaming_text, StreamingMessage, STREAM_RESPONSES, ai_slot, error_message
 
 ai_func = Router()
 
@@ -45,9 +48,8 @@ class AISelected(StatesGroup):
 
 
     #video models
-    # video = State()
-    # video_adding_prompt = State()
-    # video_editing = State()
+    video = State()
+    video_adding_prompt = State()
 
 @ai_func.message(F.text == '🔙 Назад')
 async def back_to_start_ai(message: types.Message, state: FSMContext):
@@ -66,21 +68,11 @@ async def back_to_start_ai(message: types.Message, state: FSMContext):
 @ai_func.callback_query(F.data == 'ai')
 async def start_ai(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     user_id = callback.from_user.id
-    user = await orm_get_user(session, callback.from_user.id)
-    if not user:
-        data = {'user_id': user_id,
-                'first_name': callback.from_user.first_name,
-                'last_name': callback.from_user.last_name,
-                'tokens': 200,
-                'username': callback.from_user.username
-                }
-        await orm_add_user(session, data)
-    elif user.username != callback.from_user.username:
-        await orm_update_user_name(session, user_id, callback.from_user.username)
-    elif user.first_name != callback.from_user.first_name:
-        await orm_update_first_name(session, user_id, callback.from_user.first_name)
-    elif user.last_name != callback.from_user.last_name:
-        await orm_update_last_name(session, user_id, callback.from_user.last_name)
+    user = await orm_get_user_profile(session, user_id)
+    names = (callback.from_user.first_name, callback.from_user.last_name, callback.from_user.username)
+    # новому пользователю 200 токенов, у существующего имена обновляются, только если изменились
+    if not user or (user.first_name, user.last_name, user.username) != names:
+        await orm_upsert_user_profile(session, user_id, *names, tokens=200)
 
     await callback.message.answer(
         '<b>✨ Привет, я собрал в себе все популярные нейросети для вашего удобства!</b>\n\n<u>Вот что я умею:</u>\n\n'
@@ -157,19 +149,6 @@ async def work_with_image(message: types.Message, state: FSMContext):
 
     await state.set_state(AISelected.image)
 
-#
-# @ai_func.message(F.text == '🎬 Видео')
-# async def work_with_image(message: types.Message, state: FSMContext):
-#     await message.delete()
-#     photo = FSInputFile('app/open_webapp_bot/AI/files/aspect_ratio.png')
-#     await message.answer_photo(photo=photo, caption='✨ <b>Создавайте видео прямо в чате!</b> ✨ \n\n'
-#                                                     'Сгенерируйте видео только <i>по текстовому запросу</i> или, <i>прикрепив к сообщению фото</i>, которое станет начальным кадром.\n\n'
-#                                                     'По умолчанию видео длится 5 секунд, но можно его продлить до 10, для этого в запросе напишите "продлить" в начале запроса\n\n'
-#                                                     'Также вы можете указать в запросе соотношение сторон видео(см. фото)☝️\n\n'
-#                                                     'Цена генерации: 105 токенов (5 сек)\n'
-#                                                     '                            200 токенов (10 сек)')
-#
-#     await state.set_state(AISelected.video)
 
 @ai_func.message(F.text == '🤖❗️GPT 5❗️🤖')
 async def work_with_gpt_5(message: types.Message, state: FSMContext):
@@ -210,59 +189,71 @@ async def clear_history_gpt(message: types.Message, session: AsyncSession):
     await message.answer('ℹ️ История диалога удалена, вы можете продолжать общение с ботом')
 
 @ai_func.message(AISelected.gpt_5)
-async def text_gpt(message: types.Message, session: AsyncSession, bot: Bot, http_session: aiohttp.ClientSession):
+async def text_gpt(message: types.Message, session: AsyncSession, bot: Bot):
     print('going_to_gpt')
     user_id = message.from_user.id
-    if await check_balance(session, user_id, 'gpt_5'):
-
-        stop_typing = asyncio.Event()
-        typing_task = asyncio.create_task(send_typing_action(bot, message.chat.id, stop_typing))
-
-
-        try:
-            if message.text:
-                response = await gpt_5(session, user_id, prompt=message.text)
+    if not (message.text or message.photo):
+        return
 
-            elif message.photo:
-                print('its photo')
-                image= await get_image_for_ai(bot, http_session, user_id=user_id,
-                                                      photo_id=message.photo[-1].file_id)
+    if not await reserve_tokens(session, user_id, 'gpt_5'):
+        await message.answer(
+            'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
+            reply_markup=kbd_tk)
+        return
 
-                response = await gpt_5(session, user_id, prompt=message.caption, image=image)
+    # ответ считается доставленным, как только пользователь увидел хоть его часть
+    answered = False
+    stream = StreamingMessage(message)
+    stop_typing = asyncio.Event()
+    typing_task = asyncio.create_task(send_typing_action(bot, message.chat.id, stop_typing))
+    try:
+        if message.text:
+            prompt, image = message.text, None
 
-            else:
-                return
+        else:
+            print('its photo')
+            image= await get_image_for_ai(bot, user_id=user_id,
+                                                  photo_id=message.photo[-1].file_id,
+                                                  photo_unique_id=message.photo[-1].file_unique_id)
+            prompt = message.caption
 
-            # Останавливаем typing
+        if STREAM_RESPONSES:
+            async with ai_slot(message, user_id, 'gpt_5'):
+                await send_streaming_text(message, gpt_5_stream(session, user_id, prompt=prompt, image=image), stop_typing,
+                                          stream=stream)
             stop_typing.set()
             await typing_task
+            return
 
+        async with ai_slot(message, user_id, 'gpt_5'):
+            response = await gpt_5(session, user_id, prompt=prompt, image=image)
 
-            chunks = await send_long_text(response)
-            for chunk in chunks:
+        # Останавливаем typing
+        stop_typing.set()
+        await typing_task
+
+
+        chunks = await send_long_text(response)
+        for chunk in chunks:
+            try:
+                await message.answer(chunk, parse_mode=ParseMode.MARKDOWN)
+            except Exception as e:
+                print(e)
                 try:
-                    await message.answer(chunk, parse_mode=ParseMode.MARKDOWN)
+                    await message.answer(chunk)
                 except Exception as e:
                     print(e)
-                    try:
-                        await message.answer(chunk)
-                    except Exception as e:
-                        print(e)
-                        await message.answer(chunk, parse_mode=None)
-
-            # await use_model(session, user_id, 'gpt_5')
-
-
+                    await message.answer(chunk, parse_mode=None)
+            answered = True
 
-        except Exception as e:
-            stop_typing.set()
-            await typing_task
-            print(e)
-            await message.answer("Произошла ошибка при обработке запроса. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support")
-    else:
-        await message.answer(
-        'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-        reply_markup=kbd_tk)
+    except Exception as e:
+        stop_typing.set()
+        await typing_task
+        print(e)
+        # ответ не дошёл - возвращаем токены
+        if not (answered or stream.delivered):
+            await refund_tokens(session, user_id, 'gpt_5')
+        await message.answer(error_message(e))
 
 
 @ai_func.message(AISelected.perplexity, F.text == '🗑 Отчистить историю диалога')
@@ -270,13 +261,36 @@ async def clear_history_perplexity(message: types.Message, session: AsyncSession
     await orm_delete_perplexity_chat_history(session, message.from_user.id)
     await message.answer('ℹ️ История диалога удалена, вы можете продолжать общение с ботом')
 
+
+def link_citations(text: str, citations: list | None) -> str:
+    # сноски [n] в ответе perplexity превращаются в markdown-ссылки на n-й источник
+    for n, citation in enumerate(citations or [], start=1):
+        text = text.replace(f'[{n}]', f' [{n}]({citation})')
+    return text
+
+
+async def send_citations(message: types.Message, citations: list | None):
+    if citations:
+        citations_message = '<strong>Ссылки на источники:</strong>\n'
+
+        k = 1
+        for citation in citations:
+            citations_message += f'{k} - {citation}\n'
+            k += 1
+
+        await message.answer(citations_message)
+
+
 @ai_func.message(AISelected.perplexity)
-async def text_perplexity(message: types.Message, bot: Bot, session: AsyncSession, http_session: aiohttp.ClientSession):
+async def text_perplexity(message: types.Message, bot: Bot, session: AsyncSession):
     user_id = message.from_user.id
 
 
 
-    if await check_balance(session, user_id, 'perplexity'):
+    if await reserve_tokens(session, user_id, 'perplexity'):
+        answered = False
+        extra = {}
+        stream = StreamingMessage(message, finalize=lambda chunk: link_citations(chunk, extra.get('citations')))
 
         stop_typing = asyncio.Event()
         typing_task = asyncio.create_task(send_typing_action(bot, message.chat.id, stop_typing))
@@ -284,29 +298,42 @@ async def text_perplexity(message: types.Message, bot: Bot, session: AsyncSessio
             image = None
 
             if message.photo:
-                image = await get_image_for_ai(bot, http_session, user_id=user_id,
-                                                     photo_id=message.photo[-1].file_id)
+                image = await get_image_for_ai(bot, user_id=user_id,
+                                                     photo_id=message.photo[-1].file_id,
+                                                     photo_unique_id=message.photo[-1].file_unique_id)
 
 
                 content  = message.caption if message.caption else 'Опиши фото'
 
             else:
                 content = message.text
-                if content[0] == "/": return
+                if content[0] == "/":
+                    stop_typing.set()
+                    await typing_task
+                    await refund_tokens(session, user_id, 'perplexity')
+                    return
 
             print(content)
-            ans, citations= await perp_send_request(session, user_id, content, image)
+            if STREAM_RESPONSES:
+                async with ai_slot(message, user_id, 'perplexity'):
+                    await send_streaming_text(message, perp_stream_request(session, user_id, content, image, extra), stop_typing,
+                                              stream=stream)
+                stop_typing.set()
+                await typing_task
+
+                answered = True
+                await send_citations(message, extra.get('citations'))
+                return
+
+            async with ai_slot(message, user_id, 'perplexity'):
+                ans, citations= await perp_send_request(session, user_id, content, image)
 
 
             # Останавливаем typing
             stop_typing.set()
             await typing_task
 
-            digits = []
-            for i in range(len(citations)):
-                digits.append(str(i))
-            for d in digits:
-                ans = ans.replace(f'[{d}]', f' [{d}]({citations[int(d) - 1]})')
+            ans = link_citations(ans, citations)
 
             chunks = await send_long_text(ans)
 
@@ -316,31 +343,24 @@ async def text_perplexity(message: types.Message, bot: Bot, session: AsyncSessio
                     await message.answer(chunk, parse_mode=ParseMode.MARKDOWN)
                 except Exception as e:
                     print(e)
-                    for d in digits:
-                        chunk = chunk.replace(f' [{d}]({citations[int(d)-1]})', '')
+                    for n, citation in enumerate(citations or [], start=1):
+                        chunk = chunk.replace(f' [{n}]({citation})', '')
                     try:
                         await message.answer(chunk)
                     except Exception as e:
                         print(e)
                         await message.answer(chunk, parse_mode=None)
+                answered = True
 
-            await use_model(session, user_id, 'perplexity')
-
-            if citations:
-                citations_message = '<strong>Ссылки на источники:</strong>\n'
-
-                k = 1
-                for citation in citations:
-                    citations_message += f'{k} - {citation}\n'
-                    k += 1
-
-                await message.answer(citations_message)
+            await send_citations(message, citations)
 
         except Exception as e:
             stop_typing.set()
             await typing_task
             print(e)
-            await message.answer("Произошла ошибка при обработке запроса. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support")
+            if not (answered or stream.delivered):
+                await refund_tokens(session, user_id, 'perplexity')
+            await message.answer(error_message(e))
     else:
         await message.answer(
             'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
@@ -357,25 +377,39 @@ async def text_deepseek(message: types.Message, bot: Bot, session: AsyncSession)
     user_id = message.from_user.id
 
 
-    if not await check_balance(session, user_id, 'gemini'):
+    if not await reserve_tokens(session, user_id, 'gemini'):
         await message.answer(
             'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
             reply_markup=kbd_tk)
         return
 
+    # ответ считается доставленным, как только пользователь увидел хоть его часть
+    answered = False
+    stream = StreamingMessage(message)
     stop_typing = asyncio.Event()
     typing_task = asyncio.create_task(send_typing_action(bot, message.chat.id, stop_typing))
     try:
         prompt = message.text
 
         if prompt == "/":
+            stop_typing.set()
+            await typing_task
+            await refund_tokens(session, user_id, 'gemini')
             return
 
-        ans = await deepseek(session, user_id, prompt)
-        if ans:
-            # Останавливаем typing
+        if STREAM_RESPONSES:
+            async with ai_slot(message, user_id, 'deepseek'):
+                await send_streaming_text(message, deepseek_stream(session, user_id, prompt), stop_typing,
+                                          stream=stream)
             stop_typing.set()
             await typing_task
+            return
+
+        async with ai_slot(message, user_id, 'deepseek'):
+            ans = await deepseek(session, user_id, prompt)
+        # Останавливаем typing
+        stop_typing.set()
+        await typing_task
 
         chunks = await send_long_text(ans)
         for chunk in chunks:
@@ -388,27 +422,33 @@ async def text_deepseek(message: types.Message, bot: Bot, session: AsyncSession)
                 except Exception as e:
                     print(e)
                     await message.answer(chunk, parse_mode=None)
-
-        await use_model(session, user_id, 'gemini')
+            answered = True
 
     except Exception as e:
         stop_typing.set()
         await typing_task
         print(e)
-        await message.answer("Произошла ошибка при обработке запроса. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support")
+        # ответ не дошёл - возвращаем токены
+        if not (answered or stream.delivered):
+            await refund_tokens(session, user_id, 'gemini')
+        await message.answer(error_message(e))
 
 
 
 @ai_func.message(AISelected.receipt)
-async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession, http_session: aiohttp.ClientSession):
+async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession):
+    # токены списаны заранее и вернутся, если ответ не будет отправлен
+    reserved = False
     try:
         user_id = message.from_user.id
-        if await check_balance(session, message.from_user.id, 'receipt'):
+        if await reserve_tokens(session, message.from_user.id, 'receipt'):
+            reserved = True
             await message.answer("🧠 Обрабатываю, пожалуйста подождите...")
             image = None
             if message.photo:
-                image = await get_image_for_ai(bot, http_session, user_id=user_id,
-                                                     photo_id=message.photo[-1].file_id)
+                image = await get_image_for_ai(bot, user_id=user_id,
+                                                     photo_id=message.photo[-1].file_id,
+                                                     photo_unique_id=message.photo[-1].file_unique_id)
 
                 user_prompt = 'Ты помощник по питанию. Изучи фото определи какие продукты на нем, напиши рецепты блюд которые можно из низ приготовить, добавь КБЖУ для каждого блюда. В конце ответа не задавай вопросы'
                 if message.caption:
@@ -417,9 +457,15 @@ async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession, h
             elif message.text:
                 user_prompt = message.text + 'Ты помощник по питанию. Изучи список, напиши рецепты блюд которые можно из продуктов в нем приготовить, добавь КБЖУ для каждого блюда. В конце ответа не задавай вопросы'
             else:
+                await refund_tokens(session, user_id, 'receipt')
                 return
 
-            ans = await grok_for_receipt(user_prompt, image)
+            # при попадании в кэш место в очереди к модели не занимается
+            ans = await cached_receipt(user_prompt, image)
+            cached = ans is not None
+            if not cached:
+                async with ai_slot(message, user_id, 'grok'):
+                    ans = await grok_for_receipt(user_prompt, image)
 
 
 
@@ -435,7 +481,9 @@ async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession, h
                         print(e)
                         await message.answer(chunk, parse_mode=None)
 
-            await use_model(session, message.from_user.id, 'receipt')
+            reserved = False
+            if cached and not CACHE_BILL_HITS:
+                await refund_tokens(session, user_id, 'receipt')
 
         else:
             await message.answer('К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
@@ -443,7 +491,9 @@ async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession, h
 
     except Exception as e:
         print(e)
-        await message.answer("Произошла ошибка при обработке запроса. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support")
+        if reserved:
+            await refund_tokens(session, message.from_user.id, 'receipt')
+        await message.answer(error_message(e))
 
 #
 # ######################################################################################################
@@ -451,51 +501,39 @@ async def get_receipt(message: types.Message, bot: Bot, session: AsyncSession, h
 #
 # ################################## IMAGE #############################################################
 
-users_collages = {}
+async def start_image_job(message: types.Message, session: AsyncSession, state: FSMContext, user_id: int, model: str,
+                          prompt: str, images: list[bytes] = None):
+    # Генерация идёт в фоне (image_jobs.py), картинка придёт в чат отдельным сообщением
+    if await image_jobs.enqueue(session, user_id, message.chat.id, model, prompt, images) is None:
+        await message.answer(
+            'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
+            reply_markup=kbd_tk)
+        return
+    await album_buffer.drop_pending(user_id)
+    await state.set_state(AISelected.image)
+    await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты, изображение придёт в этот чат")
+
 
 @ai_func.message(AISelected.image_adding, F.text)
 async def image_adding_gpt(message: types.Message, state: FSMContext, session: AsyncSession):
     prompt = message.text
-    data = await state.get_data()
-    key = data['image_adding']
+    user_id = message.from_user.id
     model = 'img2img'
-    images = users_collages[key]
-
-    try:
-        await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...\nПожалуйста, не переходите в другой режим пока не закончится генерация")
-        image_out = await nano_banana(prompt, users_collages[key])
-    except BadRequestError as e:
-        print(e)
-        if e.code == 'moderation_blocked':
-            await message.answer(
-                '🤖 К сожалению, я не могу создать это фото, так как запрос противоречит моей политике в отношении контента.')
-            del users_collages[key]
-            await state.set_state(AISelected.image)
-        return
-    except Exception as e:
-        print(e)
-        await message.answer('Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
+    images = await album_buffer.get_pending(user_id)
+    if not images:
+        # фото пролежали дольше ALBUM_TTL или бот перезапускался
+        await message.answer('Пожалуйста, отправьте фото ещё раз')
+        await state.set_state(AISelected.image)
         return
 
-    del users_collages[key]
-    await state.update_data(image=(prompt, images, image_out, model))
-    input_file = BufferedInputFile(file=image_out, filename="your_image.jpeg")
-
-    await state.set_state(AISelected.image)
-
-    await message.answer_document(input_file)
-    await message.answer_photo(photo=input_file, caption='Ваше изображение😌', reply_markup=get_callback_btns(btns={
-        '🔄 Повторить': 'repeat',
-        '✏️ Изменить': 'edit'
-    }))
-
-    await use_model(session, message.from_user.id, model)
+    await start_image_job(message, session, state, user_id, model, prompt,
+                          [base64.b64decode(image) for image in images])
 
 
 
 
 @ai_func.message(or_f(AISelected.image, AISelected.image_adding))
-async def to_nano_banana(message: types.Message, bot: Bot, state: FSMContext, session: AsyncSession, http_session: aiohttp.ClientSession):
+async def to_nano_banana(message: types.Message, bot: Bot, state: FSMContext, session: AsyncSession):
     model = 'img2img'
     user_id = message.from_user.id
 
@@ -503,166 +541,72 @@ async def to_nano_banana(message: types.Message, bot: Bot, state: FSMContext, se
         await message.answer('Пожалуйста, отправьте фото другим способом')
         return
 
-    await state.update_data(image=None)
-
+    if not (message.photo or message.text):
+        return
+    if message.text:
+        model = 'img2txt'
 
-    images = []
+    if not await check_balance(session, user_id, model):
+        await message.answer(
+            'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
+            reply_markup=kbd_tk)
+        return
 
 # случай если медиа группа с описанием
     if message.media_group_id:
-        if await check_balance(session, user_id, model):
-            key  = user_id
-            if key not in users_collages:
-                users_collages[key] = []
-
-
+        image= await get_image_for_ai(bot, user_id=user_id, photo_id=message.photo[-1].file_id,
+                                      photo_unique_id=message.photo[-1].file_unique_id)
+        # остальные фото альбома должны обработаться, пока это ждёт окончания сборки
+        release_chat()
+        album = await album_buffer.collect(message.media_group_id, image, message.caption)
+        if album is None:
+            # альбом ещё собирается, его обработает сообщение с последним фото
+            return
+        images, prompt = album
 
-            image= await get_image_for_ai(bot, http_session, user_id=user_id, photo_id=message.photo[-1].file_id)
-            await state.update_data(image_adding=key)
+        if not prompt:
+            await album_buffer.set_pending(user_id, images)
             await state.set_state(AISelected.image_adding)
-
-            if message.caption:
-                prompt = message.caption
-            else:
-                 return
-
-
-            await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...\nПожалуйста, не переходите в другой режим пока не закончится генерация")
-            image_out = await nano_banana(prompt, users_collages[key])
-            images.append(users_collages[key])
-
-
-        else:
-            await message.answer(
-                'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-                reply_markup=kbd_tk)
+            await message.answer('Отлично! Теперь напиши, что сделать с этими фото...')
             return
 
+        await start_image_job(message, session, state, user_id, model, prompt,
+                              [base64.b64decode(image) for image in images])
+
 #случай когда фото с описанием
 
     elif message.caption and message.photo:
-        if await check_balance(session, user_id, model):
-            image = await get_image_for_ai(bot, http_session, user_id=user_id, photo_id=message.photo[-1].file_id)
-            images.append(image)
-            prompt = message.caption
-
-
-
-
-            await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...")
-            image_out = await nano_banana(prompt, images)
-
-
-        else:
-            await message.answer(
-                'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-                reply_markup=kbd_tk)
-            return
+        image = await get_image_for_ai(bot, user_id=user_id, photo_id=message.photo[-1].file_id,
+                                       photo_unique_id=message.photo[-1].file_unique_id)
+        await start_image_job(message, session, state, user_id, model, message.caption, [base64.b64decode(image)])
 
     elif message.photo:
-        if await check_balance(session, user_id, model):
-            key = user_id
-
-
-            users_collages[key] = []
-
-
-            image = await get_image_for_ai(bot, http_session, user_id=user_id, photo_id=message.photo[-1].file_id)
-            users_collages[key].append(image)
-
-            await state.update_data(image_adding=key)
-            await state.set_state(AISelected.image_adding)
-            await message.answer('Отлично! Теперь напиши, что сделать с этим фото...')
-            return
-
-        else:
-            await message.answer(
-                'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-                reply_markup=kbd_tk)
-            return
+        image = await get_image_for_ai(bot, user_id=user_id, photo_id=message.photo[-1].file_id,
+                                       photo_unique_id=message.photo[-1].file_unique_id)
+        await album_buffer.set_pending(user_id, [image])
 
+        await state.set_state(AISelected.image_adding)
+        await message.answer('Отлично! Теперь напиши, что сделать с этим фото...')
 
     elif message.text:
-        model = 'img2txt'
-        if await check_balance(session, user_id, model):
-
-            try:
-                prompt = message.text
-                await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...")
-                image_out = await nano_banana(prompt)
-            except BadRequestError as e:
-                if e.code == 'moderation_blocked':
-                    await message.answer('🤖 К сожалению, я не могу создать это фото, так как запрос противоречит моей политике в отношении контента.')
-                return
-            except Exception as e:
-                print(e)
-                await message.answer('Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-                return
-
-        else:
-            await message.answer(
-                'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-                reply_markup=kbd_tk)
-            return
-    else:
-        return
+        await start_image_job(message, session, state, user_id, model, message.text)
 
-    await state.update_data(image=(prompt, images, image_out, model))
-    input_file = BufferedInputFile(file=image_out, filename="your_image.jpeg")
-    if user_id in users_collages:
-        del users_collages[user_id]
 
-    await message.answer_document(input_file)
-    try:
-        await message.answer_photo(photo=input_file, caption='Ваше изображение😌',
-                                   reply_markup=get_callback_btns(btns={
-                                       '🔄 Повторить': 'repeat',
-                                       '✏️ Редактировать': 'edit'
-                                   }))
-        await use_model(session, message.from_user.id, model)
-    except Exception as e:
-        print(e)
-        await message.answer(
-            'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-
-
-@ai_func.callback_query(or_f(AISelected.image_adding, AISelected.image), F.data == 'repeat')
+@ai_func.callback_query(or_f(AISelected.image_adding, AISelected.image), F.data.startswith('image_repeat:'))
 async def repeat_image(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     print('in_repeat')
     await callback.answer()
-    data = await state.get_data()
-    images = data['image'][1]
-    prompt =data['image'][0]
-    model = data['image'][-1]
-    # print(images, prompt, model)
     user_id = callback.from_user.id
+    job = await orm_get_image_job(session, int(callback.data.split(':')[1]))
+    if not job or job.user_id != user_id:
+        return
 
-
-    if await check_balance(session, user_id, model):
-
-        await callback.message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...")
-
-
-        image_out = await nano_banana(prompt, images)
-
-        await state.update_data(image=(prompt, images, image_out, model))
-        input_file = BufferedInputFile(file=image_out, filename="your_image.jpeg")
-        await state.set_state(AISelected.image)
-
-        await callback.message.answer_document(input_file)
-        try:
-            await callback.message.answer_photo(photo=input_file, caption='Ваше изображение😌',
-                                       reply_markup=get_callback_btns(btns={
-                                           '🔄 Повторить': 'repeat',
-                                           '✏️ Редактировать': 'edit'
-                                       }))
-            await use_model(session, callback.message.from_user.id, model)
-        except Exception as e:
-            print(e)
-            await callback.message.answer(
-                'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-
-
+    if await check_balance(session, user_id, job.model):
+        images = [await get_blob(digest) for digest in job.images]
+        if None in images:
+            await callback.message.answer('Пожалуйста, отправьте фото ещё раз')
+            return
+        await start_image_job(callback.message, session, state, user_id, job.model, job.prompt, images)
 
     else:
         await callback.message.answer(
@@ -671,11 +615,12 @@ async def repeat_image(callback: types.CallbackQuery, state: FSMContext, session
 
 
 
-@ai_func.callback_query(or_f(AISelected.image_adding, AISelected.image), F.data == 'edit')
+@ai_func.callback_query(or_f(AISelected.image_adding, AISelected.image), F.data.startswith('image_edit:'))
 async def enter_edit(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     if await check_balance(session, callback.from_user.id, 'img2img'):
         print('editing')
         await callback.answer()
+        await state.update_data(image_job=int(callback.data.split(':')[1]))
         await callback.message.answer("Что бы вы хотели изменить?")
         await state.set_state(AISelected.image_editing)
 
@@ -687,41 +632,20 @@ async def enter_edit(callback: types.CallbackQuery, state: FSMContext, session:
 
 
 @ai_func.message(AISelected.image_editing, F.text)
-async def editing(message: types.Message, state: FSMContext, bot: Bot, session: AsyncSession, http_session: aiohttp.ClientSession):
+async def editing(message: types.Message, state: FSMContext, session: AsyncSession):
 
     #реализовать добавление фото
     model = 'img2img'
-    prompt = message.text
+    user_id = message.from_user.id
     data = await state.get_data()
-    image_bytes = data['image'][-2]
-    image = await get_image_for_ai(bot, http_session, user_id=message.from_user.id, photo_bytes=image_bytes)
-    print(image)
-
-    await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет 2-3 минуты...")
-    try:
-        image_out = await nano_banana(prompt, [image])
-
-    except Exception as e:
-        print(e)
-        await message.answer('Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
+    job = await orm_get_image_job(session, data.get('image_job', 0))
+    image = await get_blob(job.result) if job and job.user_id == user_id and job.result else None
+    if image is None:
+        await message.answer('Пожалуйста, отправьте фото ещё раз')
+        await state.set_state(AISelected.image)
         return
 
-    await state.update_data(image=(prompt, image, image_out, model))
-    input_file = BufferedInputFile(file=image_out, filename="your_image.jpeg")
-
-    await state.set_state(AISelected.image)
-
-    await message.answer_document(input_file)
-    try:
-        await message.answer_photo(photo=input_file, caption='Ваше изображение😌',
-                                        reply_markup=get_callback_btns(btns={
-                                            '🔄 Повторить': 'repeat',
-                                            '✏️ Редактировать': 'edit'
-                                        }))
-        await use_model(session, message.from_user.id, model)
-    except Exception as e:
-        print(e)
-        await message.answer('Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
+    await start_image_job(message, session, state, user_id, model, message.text, [image])
 
 
 
@@ -838,380 +762,104 @@ async def editing(message: types.Message, state: FSMContext, bot: Bot, session:
 #
 #
 ################################## VIDEO #############################################################
-#
-# ratios = ['16:9','4:3','1:1','3:4','9:16','21:9','9:21']
-#
-# @ai_func.message(AISelected.video)
-# async def video(message: types.Message, bot: Bot, state: FSMContext, session: AsyncSession, http_session: aiohttp.ClientSession):
-#     print('lets go make video')
-#     user_id = message.from_user.id
-#     model = 'video'
-#     if await check_balance(session, user_id, 'video'):
-#
-#         ratio = '16:9'
-#         long = False
-#         image_data = None
-#         image = None
-#
-#         if message.photo:
-#             file_id = message.photo[-1].file_id
-#             file_info = await bot.get_file(file_id)
-#
-#             file_path = file_info.file_path
-#
-#             file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-#             async with http_session.get(file_url) as response:
-#                 if response.status != 200:
-#                     # Обработка ошибок HTTP
-#                     text = await response.text()
-#                     raise Exception(f"HTTP error {response.status}: {text}")
-#                 data = await response.content.read()
-#
-#                 image = f"files/image_for_video{user_id}.jpeg"
-#                 with open(image, "wb") as f:
-#                     f.write(data)
-#                     print(f'saved to {image}')
-#
-#             image_data = await get_image_for_video(image)
-#
-#             if message.caption:
-#                 prompt = message.caption
-#             else:
-#                 await state.update_data(video_adding_prompt=image_data)
-#                 await state.set_state(AISelected.video_adding_prompt)
-#                 await message.answer('Отлично! Теперь напиши, что сделать с этим фото...')
-#                 return
-#
-#
-#         elif message.text:
-#
-#             prompt = message.text
-#
-#             for r in ratios:
-#
-#                 if r in prompt:
-#                     ratio = r
-#
-#                     break
-#
-#
-#         elif message.document:
-#
-#             await message.answer('Пожалуйста, отправьте фото другим способом')
-#
-#             return
-#
-#
-#         else:
-#
-#             return
-#
-#         if 'продлить' in prompt.lower():
-#
-#             if await check_balance(session, user_id, 'video_long'):
-#
-#                 long = True
-#
-#                 ind = prompt.lower().find('продлить')
-#
-#                 prompt = prompt[ind + 7:]
-#
-#                 model = 'video_long'
-#
-#             else:
-#
-#                 await message.answer(
-#
-#                     'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием вы      полню ваш запрос!',
-#
-#                     reply_markup=kbd_tk)
-#
-#                 return
-#
-#         await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет около 2 минут...")
-#
-#         await state.update_data(video=(prompt, ratio, image_data, long))
-#
-#         try:
-#
-#             video_url = await veo_text_to_video(http_session, prompt, ratio, image_data, long)
-#
-#         except Exception as e:
-#
-#             print(e)
-#
-#             await message.answer(
-#
-#                 'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#             return
-#
-#         if image:
-#             os.remove(image)
-#
-#             print(f'deleted from {image}')
-#
-#         await message.answer_video(video=video_url, caption='Ваше видео😌', reply_markup=get_callback_btns(btns={
-#
-#             '🔄 Повторить': 'repeat',
-#
-#             '✏️ Изменить': 'edit'
-#
-#         }))
-#
-#         await use_model(session, user_id, model)
-#
-#
-#     else:
-#
-#         await message.answer(
-#
-#             'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-#
-#             reply_markup=kbd_tk)
-#
-#
-# @ai_func.message(AISelected.video_adding_prompt, F.text)
-# async def video_add_prompt(message: types.Message, state: FSMContext, session: AsyncSession,
-#                            http_session: aiohttp.ClientSession):
-#     user_id = message.from_user.id
-#
-#     ratio = '16:9'
-#
-#     long = False
-#
-#     model = 'video'
-#
-#     data = await state.get_data()
-#
-#     image_data = data['video_adding_prompt']
-#
-#     prompt = message.text
-#
-#     if 'продлить' in prompt.lower():
-#
-#         if await check_balance(session, user_id, 'video_long'):
-#
-#             long = True
-#
-#             ind = prompt.lower().find('продлить')
-#
-#             prompt = prompt[ind + 7:]
-#
-#             model = 'video_long'
-#
-#         else:
-#
-#             await message.answer(
-#
-#                 'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-#
-#                 reply_markup=kbd_tk)
-#
-#             return
-#
-#     await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет около 2 минут...")
-#
-#     try:
-#
-#         video_url = await veo_text_to_video(http_session, prompt, ratio, image_data, long)
-#
-#     except Exception as e:
-#
-#         print(e)
-#
-#         await message.answer(
-#
-#             'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#         return
-#
-#     await state.update_data(video=(prompt, ratio, image_data, long))
-#
-#     try:
-#
-#         await message.answer_video(video=video_url, caption='Ваше видео😌', reply_markup=get_callback_btns(btns={
-#
-#             '🔄 Повторить': 'repeat',
-#
-#             '✏️ Изменить': 'edit'
-#
-#         }))
-#
-#     except Exception as e:
-#
-#         print(e)
-#
-#         await message.answer(
-#             'Возникла непредвиденная ошибка, пожалуйста, повторите попытку.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#         return
-#
-#     await use_model(session, user_id, model)
-#
-#     await state.set_state(AISelected.video)
-#
-#
-# @ai_func.callback_query(AISelected.video, F.data == 'repeat')
-# async def video_repeat(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession,
-#                        http_session: aiohttp.ClientSession):
-#     user_id = callback.from_user.id
-#
-#     data = await state.get_data()
-#
-#     video_data = data['video']
-#
-#     prompt = video_data[0]
-#
-#     ratio = video_data[1]
-#
-#     image_data = video_data[-2]
-#
-#     long = video_data[-1]
-#
-#     if long:
-#
-#         model = 'video_long'
-#
-#     else:
-#
-#         model = 'video'
-#
-#     if await check_balance(session, user_id, model):
-#
-#         await callback.answer()
-#
-#         await callback.message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет около 2 минут...")
-#
-#         try:
-#
-#             video_url = await veo_text_to_video(http_session, prompt, ratio, image_data, long)
-#
-#         except Exception as e:
-#
-#             print(e)
-#
-#             await callback.message.answer(
-#
-#                 'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#             return
-#
-#         try:
-#
-#             await callback.message.answer_video(video=video_url, caption='Ваше видео😌',
-#                                                 reply_markup=get_callback_btns(btns={
-#
-#                                                     '🔄 Повторить': 'repeat',
-#
-#                                                     '✏️ Редактировать': 'edit'
-#
-#                                                 }))
-#
-#         except Exception as e:
-#
-#             await callback.message.answer(
-#                 'Возникла непредвиденная ошибка, пожалуйста, повторите попытку.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#             return
-#
-#         await use_model(session, user_id, model)
-#
-#
-#     else:
-#
-#         await callback.message.answer(
-#
-#             'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-#
-#             reply_markup=kbd_tk)
-#
-#
-# @ai_func.callback_query(AISelected.video, F.data == 'edit')
-# async def video_enter_edit(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
-#     data = await state.get_data()
-#
-#     long = data['video'][-1]
-#
-#     user_id = callback.from_user.id
-#
-#     if long:
-#
-#         model = 'video_long'
-#
-#     else:
-#
-#         model = 'video'
-#
-#     if await check_balance(session, user_id, model):
-#
-#         await callback.answer()
-#
-#         await callback.message.answer("Что бы вы хотели изменить?")
-#
-#         await state.set_state(AISelected.video_editing)
-#
-#     else:
-#
-#         await callback.message.answer(
-#
-#             'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
-#
-#             reply_markup=kbd_tk)
-#
-#
-# @ai_func.message(AISelected.video_editing, F.text)
-# async def editing_video(message: types.Message, state: FSMContext, session: AsyncSession,
-#                         http_session: aiohttp.ClientSession):
-#     await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет около 2 минут...")
-#
-#     data = await state.get_data()
-#
-#     video_data = data['video']
-#
-#     prompt = video_data[0] + message.text
-#
-#     ratio = video_data[1]
-#
-#     image_data = video_data[-2]
-#
-#     long = video_data[-1]
-#
-#     if long:
-#
-#         model = 'video_long'
-#
-#     else:
-#
-#         model = 'video'
-#
-#     await state.update_data(video=(prompt, ratio, image_data, long))
-#
-#     try:
-#
-#         video_url = await veo_text_to_video(http_session, prompt, ratio, image_data, long)
-#
-#     except Exception as e:
-#
-#         print(e)
-#
-#         await message.answer(
-#
-#             'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support')
-#
-#         return
-#
-#     await message.answer_video(video=video_url, caption='Ваше видео😌',
-#
-#                                reply_markup=get_callback_btns(btns={
-#
-#                                    '🔄 Повторить': 'repeat',
-#
-#                                    '✏️ Редактировать': 'edit'
-#
-#                                }))
-#
-#     await use_model(session, message.from_user.id, model)
-#
-#     await state.set_state(AISelected.video)
-#
+
+# Обработчики видео подключаются к ai_func только при VIDEO_ENABLED=1 (см. конец файла),
+# иначе набранное вручную «🎬 Видео» не должно создавать платные генерации
+video_func = Router()
+
+@video_func.message(F.text == '🎬 Видео')
+async def work_with_video(message: types.Message, state: FSMContext):
+    await message.delete()
+    photo = FSInputFile('app/open_webapp_bot/AI/files/aspect_ratio.png')
+    await message.answer_photo(photo=photo, caption='✨ <b>Создавайте видео прямо в чате!</b> ✨ \n\n'
+                                                    'Сгенерируйте видео только <i>по текстовому запросу</i> или, <i>прикрепив к сообщению фото</i>, которое станет начальным кадром.\n\n'
+                                                    'По умолчанию видео длится 5 секунд, но можно его продлить до 10, для этого в запросе напишите "продлить" в начале запроса\n\n'
+                                                    'Также вы можете указать в запросе соотношение сторон видео(см. фото)☝️\n\n'
+                                                    'Цена генерации: 105 токенов (5 сек)\n'
+                                                    '                            200 токенов (10 сек)')
+
+    await state.set_state(AISelected.video)
+
+
+ratios = ['16:9','4:3','1:1','3:4','9:16','21:9','9:21']
+
+
+async def start_video_generation(message: types.Message, session: AsyncSession, state: FSMContext, user_id: int,
+                                 prompt: str, image: str = None):
+    # Видео опрашивает video_tracker в фоне и присылает в чат, когда оно готово
+    ratio = '16:9'
+    for r in ratios:
+        if r in prompt:
+            ratio = r
+            break
+
+    long = 'продлить' in prompt.lower()
+    model = 'video_long' if long else 'video'
+    if long:
+        prompt = prompt[prompt.lower().find('продлить') + len('продлить'):]
+
+    try:
+        image_uri = f'data:image/jpeg;base64,{image}' if image else None
+        generation_id = await video_tracker.start_generation(session, user_id, message.chat.id, model, prompt,
+                                                             ratio, image_uri, long)
+    except Exception as e:
+        print(e)
+        await message.answer(error_message(e))
+        return
+
+    if generation_id is None:
+        await message.answer(
+            'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
+            reply_markup=kbd_tk)
+        return
+    await album_buffer.drop_pending(user_id)
+    await state.set_state(AISelected.video)
+    await message.answer("🧠 Обрабатываю, пожалуйста подождите.\nГенерация займет около 2 минут, видео придёт в этот чат")
+
+
+@video_func.message(AISelected.video_adding_prompt, F.text)
+async def video_add_prompt(message: types.Message, state: FSMContext, session: AsyncSession):
+    user_id = message.from_user.id
+    images = await album_buffer.get_pending(user_id)
+    if not images:
+        # фото пролежало дольше ALBUM_TTL или бот перезапускался
+        await message.answer('Пожалуйста, отправьте фото ещё раз')
+        await state.set_state(AISelected.video)
+        return
+
+    await start_video_generation(message, session, state, user_id, message.text, images[0])
+
+
+@video_func.message(or_f(AISelected.video, AISelected.video_adding_prompt))
+async def video(message: types.Message, bot: Bot, state: FSMContext, session: AsyncSession):
+    user_id = message.from_user.id
+
+    if message.document:
+        await message.answer('Пожалуйста, отправьте фото другим способом')
+        return
+
+    if not (message.photo or message.text):
+        return
+
+    if not await check_balance(session, user_id, 'video'):
+        await message.answer(
+            'К сожалению, у вас закончились токены.\n\n Пожалуйста, пополните счёт, и я с удовольствием выполню ваш запрос!',
+            reply_markup=kbd_tk)
+        return
+
+    if message.photo:
+        image = await get_image_for_ai(bot, user_id=user_id, photo_id=message.photo[-1].file_id,
+                                       photo_unique_id=message.photo[-1].file_unique_id)
+        if not message.caption:
+            await album_buffer.set_pending(user_id, [image])
+            await state.set_state(AISelected.video_adding_prompt)
+            await message.answer('Отлично! Теперь напиши, что сделать с этим фото...')
+            return
+        await start_video_generation(message, session, state, user_id, message.caption, image)
+
+    else:
+        await start_video_generation(message, session, state, user_id, message.text)
+
+
+if VIDEO_ENABLED:
+    ai_func.include_router(video_func)
@@ -1,16 +1,27 @@
+import csv
+import html
+import io
+import os
 from datetime import date
 
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.types import BufferedInputFile
 from sqlalchemy.ext.asyncio import AsyncSession
 
 
+from app.open_webapp_bot.AI.api_requests.cache import receipt_cache
+from app.open_webapp_bot.AI.api_requests.scheduler import scheduler
 from app.open_webapp_bot.AI.database.clear_chats import clear_history_periodically
-from app.open_webapp_bot.AI.database.orm_query import orm_get_user_id, orm_get_user, orm_update_balance, \
-    orm_add_promo_code, orm_get_promo_codes, orm_delete_promo_code
+from app.open_webapp_bot.AI.database.orm_query import orm_get_user_id, orm_update_balance, \
+    orm_add_promo_code, orm_delete_promo_code, orm_get_promo_report
+from app.open_webapp_bot.AI.database.user_cache import user_cache
 from app.open_webapp_bot.AI.filters.chat_type import IsAdmin
+from app.open_webapp_bot.AI.handlers.album_buffer import album_buffer
+from app.open_webapp_bot.AI.handlers.processing import send_long_text, MESS_MAX_LENGTH
+from app.open_webapp_bot.AI.handlers.telegram_media import media_fetcher
 from app.open_webapp_bot.AI.kbds.inline import get_callback_btns
 
 admin_router = Router()
@@ -33,7 +44,8 @@ async def enter_admin(message: types.Message):
         'Установить таймер': 'set_timer',
         'Дать токенов': 'give_tk',
         'Промокоды': 'admin_promo_code',
-        'Проверить пользователя': 'check_a_man'
+        'Проверить пользователя': 'check_a_man',
+        'Очередь ИИ': 'ai_queue'
     }))
 
 ################################## timer ####################################################################
@@ -42,6 +54,33 @@ async def set_timer(callback: types.CallbackQuery, session: AsyncSession):
     await callback.answer('установлен таймер на 90 дней')
     await clear_history_periodically(session)
 
+################################## queue ####################################################################
+
+@admin_router.callback_query(F.data == 'ai_queue')
+async def ai_queue(callback: types.CallbackQuery):
+    await callback.answer()
+    text = ''
+    for model, stats in scheduler.stats().items():
+        text += (f'\n<b>{model}</b>\nВ работе: {stats["running"]}\nВ очереди: {stats["queued"]}\n'
+                 f'Выполнено: {stats["served"]}\nОжидание: среднее {stats["avg_wait"]:.1f} с, макс {stats["max_wait"]:.1f} с\n')
+
+    cache = receipt_cache.stats()
+    text += (f'\n<b>Кэш рецептов</b>\nПопаданий: {cache["hits"]}\nПромахов: {cache["misses"]}\n'
+             f'Доля попаданий: {cache["hit_rate"]:.0%}\nЗаписей в памяти: {cache["items"]}\n')
+
+    media = media_fetcher.stats()
+    text += (f'\n<b>Кэш файлов Telegram</b>\nПопаданий: {media["hits"]}\nПромахов: {media["misses"]}\n'
+             f'Вызовов get_file: {media["get_file_calls"]}\nВ памяти: {media["items"]} ({media["bytes"] / 1024 / 1024:.1f} МБ)\n')
+
+    users = user_cache.stats()
+    text += (f'\n<b>Кэш пользователей</b>\nПопаданий: {users["hits"]}\nПромахов: {users["misses"]}\n'
+             f'Доля попаданий: {users["hit_rate"]:.0%}\nЗаписей в памяти: {users["items"]}\nСбросов: {users["invalidations"]}\n')
+
+    albums = album_buffer.stats()
+    if albums:
+        text += f'\n<b>Альбомы</b>\nВ буфере: {albums["items"]} ({albums["bytes"] / 1024 / 1024:.1f} МБ)\n'
+    await callback.message.answer(text)
+
 ################################## tokens ####################################################################
 
 @admin_router.callback_query(F.data == 'give_tk')
@@ -54,8 +93,7 @@ async def give_tokens(callback: types.CallbackQuery, state: FSMContext):
 async def get_user_for_tk(message: types.Message, session: AsyncSession, state: FSMContext):
     user_name = message.text[1:]
     user_id = await orm_get_user_id(session, user_name)
-    user = await orm_get_user(session, user_id)
-    if user:
+    if user_id:
         await state.update_data(to_whom=(user_id, user_name))
         await message.answer('Сколько токенов начислить')
         await state.set_state(AdminState.amount)
@@ -119,22 +157,59 @@ async def add_full_code(message: types.Message, session: AsyncSession, state: FS
     await state.clear()
 
 
+# в отчёте по каждому коду показываются первые PROMO_REPORT_USERS активаций, полный список - в CSV
+PROMO_REPORT_USERS = int(os.getenv('PROMO_REPORT_USERS', 50))
+
+
+def redeemer_name(user_id: int, username: str | None) -> str:
+    return f'@{username}' if username else str(user_id)
+
+
 @admin_router.callback_query(F.data == 'check_codes')
 async def check_codes(callback: types.CallbackQuery, session: AsyncSession):
     await callback.answer()
-    text = ''
-    for promo_code in await orm_get_promo_codes(session):
-        user_names = ''
-        usage = promo_code.used_by
-        for user in usage:
-            raw_user = await orm_get_user(session, user)
-            user_names += f'@{raw_user.username} '
-
-        text += f'\nКод: {promo_code.code}\nЦенность: {promo_code.value}\nДата окончания: {promo_code.date_end}\nБыл использован: {user_names}\n'
-    if text:
-        await callback.message.answer(text)
-    else:
+    codes = {}
+    for code, value, date_end, user_id, username, used in await orm_get_promo_report(session, PROMO_REPORT_USERS):
+        item = codes.setdefault(code, (value, date_end, used, []))
+        if user_id is not None:
+            item[3].append(redeemer_name(user_id, username))
+
+    if not codes:
         await callback.message.answer('Промокодов нет')
+        return
+
+    blocks = []
+    for code, (value, date_end, used, user_names) in codes.items():
+        more = f' и ещё {used - len(user_names)}' if used > len(user_names) else ''
+        blocks.append(f'\nКод: {html.escape(code)}\nЦенность: {value}\nДата окончания: {date_end}\n'
+                      f'Использований: {used}\nБыл использован: {" ".join(user_names)}{more}\n')
+
+    # целые коды собираются в сообщения до лимита Telegram, слишком длинный код режется send_long_text
+    pages = ['']
+    for block in blocks:
+        if len(pages[-1]) + len(block) > MESS_MAX_LENGTH:
+            pages.append('')
+        if len(block) > MESS_MAX_LENGTH:
+            pages[-1:] = await send_long_text(block) + ['']
+        else:
+            pages[-1] += block
+    pages = [page for page in pages if page]
+
+    for page in pages[:-1]:
+        await callback.message.answer(page)
+    await callback.message.answer(pages[-1], reply_markup=get_callback_btns(btns={'📄 Выгрузить CSV': 'check_codes_csv'}))
+
+
+@admin_router.callback_query(F.data == 'check_codes_csv')
+async def check_codes_csv(callback: types.CallbackQuery, session: AsyncSession):
+    await callback.answer()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['code', 'value', 'date_end', 'user_id', 'username'])
+    for code, value, date_end, user_id, username, _ in await orm_get_promo_report(session):
+        writer.writerow([code, value, date_end, user_id or '', username or ''])
+    document = BufferedInputFile(buffer.getvalue().encode('utf-8-sig'), filename=f'promo_codes_{date.today()}.csv')
+    await callback.message.answer_document(document)
 
 
 @admin_router.callback_query(F.data == 'delete_code')
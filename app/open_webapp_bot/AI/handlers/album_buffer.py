@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+# Telegram присылает альбом отдельными сообщениями с общим media_group_id.
+# Фото складываются в буфер, и альбом считается собранным, когда за ALBUM_DEBOUNCE секунд
+# не пришло ни одного нового фото. Фото, ждущие текстового запроса, лежат там же под ключом пользователя.
+ALBUM_DEBOUNCE = float(os.getenv('ALBUM_DEBOUNCE', 1.0))
+ALBUM_TTL = float(os.getenv('ALBUM_TTL', 15 * 60))
+ALBUM_MAX_IMAGES = int(os.getenv('ALBUM_MAX_IMAGES', 10))
+ALBUM_MAX_BYTES = int(os.getenv('ALBUM_MAX_BYTES', 64 * 1024 * 1024))
+# длиннее подпись к фото в Telegram не бывает, больше и не храним
+ALBUM_MAX_CAPTION = int(os.getenv('ALBUM_MAX_CAPTION', 1024))
+# redis://... - собирать альбомы в Redis, чтобы их видели все процессы бота
+ALBUM_REDIS_URL = os.getenv('ALBUM_REDIS_URL', '')
+
+
+class MemoryAlbumBackend:
+    # Хранилище в памяти процесса с тем же поведением, что и RedisAlbumBackend.
+    # Записи живут ttl секунд, при превышении max_bytes (фото и подписи вместе) вытесняются самые старые.
+    def __init__(self, max_bytes: int = ALBUM_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lists: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self.values: OrderedDict[str, tuple[float, str]] = OrderedDict()
+
+    def _alive(self, key: str):
+        item = self.lists.get(key)
+        if item and item[0] <= time.monotonic():
+            self._drop(key)
+            return None
+        return item
+
+    def _drop(self, key: str):
+        _, items = self.lists.pop(key)
+        self.size -= sum(len(item) for item in items)
+
+    def _drop_value(self, key: str):
+        _, value = self.values.pop(key)
+        self.size -= len(value)
+
+    def _evict(self):
+        # сначала самые старые альбомы, последний оставляем: его сейчас собирают
+        while self.size > self.max_bytes and len(self.lists) > 1:
+            self._drop(next(iter(self.lists)))
+        while self.size > self.max_bytes and len(self.values) > 1:
+            self._drop_value(next(iter(self.values)))
+
+    async def push(self, key: str, value: str, ttl: float) -> int:
+        item = self._alive(key)
+        items = item[1] if item else []
+        items.append(value)
+        self.lists[key] = (time.monotonic() + ttl, items)
+        self.lists.move_to_end(key)
+        self.size += len(value)
+        self._evict()
+        return len(items)
+
+    async def length(self, key: str) -> int:
+        item = self._alive(key)
+        return len(item[1]) if item else 0
+
+    async def get_list(self, key: str) -> list[str]:
+        item = self._alive(key)
+        return list(item[1]) if item else []
+
+    async def pop_list(self, key: str) -> list[str]:
+        item = self._alive(key)
+        if not item:
+            return []
+        self._drop(key)
+        return item[1]
+
+    async def set(self, key: str, value: str, ttl: float):
+        if key in self.values:
+            self._drop_value(key)
+        self.values[key] = (time.monotonic() + ttl, value)
+        self.size += len(value)
+        now = time.monotonic()
+        for old_key in [k for k, (expires, _) in self.values.items() if expires <= now]:
+            self._drop_value(old_key)
+        self._evict()
+
+    async def pop(self, key: str) -> str | None:
+        if key not in self.values:
+            return None
+        expires, value = self.values[key]
+        self._drop_value(key)
+        return value if expires > time.monotonic() else None
+
+    def stats(self) -> dict:
+        return {'items': len(self.lists), 'bytes': self.size}
+
+
+class RedisAlbumBackend:
+    # Тот же набор операций поверх redis.asyncio (подойдёт любой Redis-совместимый сервер)
+    def __init__(self, redis):
+        self.redis = redis
+
+    async def push(self, key: str, value: str, ttl: float) -> int:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, value)
+            pipe.pexpire(key, int(ttl * 1000))
+            length, _ = await pipe.execute()
+        return length
+
+    async def length(self, key: str) -> int:
+        return await self.redis.llen(key)
+
+    async def get_list(self, key: str) -> list[str]:
+        return await self.redis.lrange(key, 0, -1)
+
+    async def pop_list(self, key: str) -> list[str]:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(key, 0, -1)
+            pipe.delete(key)
+            items, _ = await pipe.execute()
+        return items
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self.redis.set(key, value, px=int(ttl * 1000))
+
+    async def pop(self, key: str) -> str | None:
+        return await self.redis.getdel(key)
+
+    def stats(self) -> dict:
+        return {}
+
+
+class AlbumBuffer:
+    def __init__(self, backend, debounce: float = ALBUM_DEBOUNCE, ttl: float = ALBUM_TTL,
+                 max_images: int = ALBUM_MAX_IMAGES):
+        self.backend = backend
+        self.debounce = debounce
+        self.ttl = ttl
+        self.max_images = max_images
+
+    async def collect(self, media_group_id: str, image: str, caption: str | None = None):
+        """Добавляет фото в альбом. Возвращает (images, caption) только обработчику последнего фото,
+        остальным - None"""
+        key = f'album:{media_group_id}'
+        if caption:
+            await self.backend.set(f'{key}:caption', caption[:ALBUM_MAX_CAPTION], self.ttl)
+        position = await self.backend.push(key, image, self.ttl)
+        await asyncio.sleep(self.debounce)
+        if await self.backend.length(key) != position:
+            # пришло ещё фото, альбом закроет его обработчик
+            return None
+        images = await self.backend.pop_list(key)
+        if not images:
+            return None
+        caption = await self.backend.pop(f'{key}:caption')
+        return images[:self.max_images], caption
+
+    async def set_pending(self, user_id: int, images: list[str]):
+        """Фото, которые ждут текстового запроса пользователя"""
+        key = f'pending:{user_id}'
+        await self.backend.pop_list(key)
+        for image in images[:self.max_images]:
+            await self.backend.push(key, image, self.ttl)
+
+    async def get_pending(self, user_id: int) -> list[str]:
+        return await self.backend.get_list(f'pending:{user_id}')
+
+    async def drop_pending(self, user_id: int):
+        await self.backend.pop_list(f'pending:{user_id}')
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+
+def create_album_buffer() -> AlbumBuffer:
+    if ALBUM_REDIS_URL:
+        from redis import asyncio as aioredis
+        return AlbumBuffer(RedisAlbumBackend(aioredis.from_url(ALBUM_REDIS_URL, decode_responses=True)))
+    return AlbumBuffer(MemoryAlbumBackend())
+
+
+album_buffer = create_album_buffer()
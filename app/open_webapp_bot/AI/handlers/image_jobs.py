@@ -0,0 +1,186 @@
+import asyncio
+import base64
+import os
+import random
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.types import BufferedInputFile
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from app.open_webapp_bot.AI.api_requests.nano_banana import nano_banana
+from app.open_webapp_bot.AI.api_requests.resilience import AIRequestError
+from app.open_webapp_bot.AI.api_requests.scheduler import scheduler
+from app.open_webapp_bot.AI.database.blob_store import get_blob
+from app.open_webapp_bot.AI.database.orm_query import orm_add_image_job, orm_claim_image_jobs, \
+    orm_update_image_job, orm_bill_image_job, orm_refund_image_job, orm_save_blob, orm_delete_old_image_jobs, \
+    orm_release_image_jobs
+from app.open_webapp_bot.AI.handlers.processing import rate
+from app.open_webapp_bot.AI.kbds.inline import get_callback_btns
+
+# Генерации картинок выполняются как задачи из таблицы image_job: обработчик только ставит задачу
+# и сразу отвечает, а результат присылает воркер. Задачи переживают перезапуск бота, шаги
+# «сгенерировать», «отправить», «списать» отмечаются в задаче, поэтому повтор не делает их дважды.
+# Стоимость списывается при постановке задачи и возвращается, если картинку так и не удалось сделать.
+IMAGE_JOB_WORKERS = int(os.getenv('IMAGE_JOB_WORKERS', 8))
+IMAGE_JOB_TICK = float(os.getenv('IMAGE_JOB_TICK', 1))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.getenv('IMAGE_JOB_MAX_ATTEMPTS', 3))
+# генерация с ожиданием в очереди к модели укладывается в это время, иначе задачу подхватит другой воркер
+IMAGE_JOB_LEASE = float(os.getenv('IMAGE_JOB_LEASE', 15 * 60))
+IMAGE_JOB_RETENTION = float(os.getenv('IMAGE_JOB_RETENTION', 7 * 24 * 60 * 60))
+IMAGE_JOB_CLEANUP_INTERVAL = float(os.getenv('IMAGE_JOB_CLEANUP_INTERVAL', 60 * 60))
+
+MODERATION_TEXT = '🤖 К сожалению, я не могу создать это фото, так как запрос противоречит моей политике в отношении контента.'
+ERROR_TEXT = 'Возникла непредвиденная ошибка, пожалуйста, повторите попытку позже.\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support'
+
+
+def image_buttons(job_id: int):
+    return get_callback_btns(btns={
+        '🔄 Повторить': f'image_repeat:{job_id}',
+        '✏️ Редактировать': f'image_edit:{job_id}'
+    })
+
+
+class ImageJobWorker:
+    def __init__(self, workers: int = IMAGE_JOB_WORKERS):
+        self.bot: Bot | None = None
+        self.session_pool: async_sessionmaker | None = None
+        self.workers = workers
+        # задача -> id задачи в image_job
+        self.active: dict[asyncio.Task, int] = {}
+        self._task: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+        self._next_cleanup = 0.0
+
+    async def enqueue(self, session: AsyncSession, user_id: int, chat_id: int, model: str, prompt: str,
+                      images: list[bytes] = None) -> int | None:
+        """Списывает стоимость и ставит задачу, None - у пользователя не хватает токенов"""
+        job_id = await orm_add_image_job(session, user_id, chat_id, model, prompt, images or [], rate[model])
+        if job_id is not None:
+            self._wakeup.set()
+        return job_id
+
+    def start(self, bot: Bot, session_pool: async_sessionmaker):
+        self.bot = bot
+        self.session_pool = session_pool
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # незавершённые задачи остаются в базе, закрепление с них снимается,
+        # чтобы другой процесс или этот после перезапуска взял их сразу, а не через IMAGE_JOB_LEASE
+        if self._task:
+            self._task.cancel()
+            unfinished = [job_id for task, job_id in self.active.items() if not task.done()]
+            for task in self.active:
+                task.cancel()
+            await asyncio.gather(self._task, *self.active, return_exceptions=True)
+            self._task = None
+            if unfinished:
+                try:
+                    async with self.session_pool() as session:
+                        await orm_release_image_jobs(session, unfinished)
+                except Exception as e:
+                    print(e)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            try:
+                free = self.workers - len(self.active)
+                if free > 0:
+                    async with self.session_pool() as session:
+                        jobs = await orm_claim_image_jobs(session, free, IMAGE_JOB_LEASE)
+                    for job in jobs:
+                        task = asyncio.create_task(self._process(job))
+                        self.active[task] = job.id
+                        task.add_done_callback(self._done)
+
+                if loop.time() >= self._next_cleanup:
+                    self._next_cleanup = loop.time() + IMAGE_JOB_CLEANUP_INTERVAL
+                    async with self.session_pool() as session:
+                        await orm_delete_old_image_jobs(
+                            session, datetime.now() - timedelta(seconds=IMAGE_JOB_RETENTION))
+            except Exception as e:
+                print(e)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), IMAGE_JOB_TICK)
+            except asyncio.TimeoutError:
+                pass
+
+    def _done(self, task: asyncio.Task):
+        self.active.pop(task, None)
+        # освободилось место - можно сразу взять следующую задачу
+        self._wakeup.set()
+
+    async def _generate(self, job) -> bytes:
+        images = []
+        for digest in job.images:
+            data = await get_blob(digest)
+            if data is None:
+                raise AIRequestError('nano_banana', 'bad_request', detail=f'blob {digest} not found')
+            images.append(base64.b64encode(data).decode('utf-8'))
+
+        async def notify(position: int):
+            await self.bot.send_message(job.chat_id, f'⏳ Сейчас много запросов, вы #{position} в очереди. Ответ придёт автоматически')
+
+        # повторная попытка задачи не должна снова сообщать о месте в очереди
+        async with scheduler.slot('nano_banana', job.user_id, on_queued=notify if job.attempts == 0 else None):
+            return await nano_banana(job.prompt, images or None)
+
+    async def _process(self, job):
+        try:
+            if job.result is None:
+                image_out = await self._generate(job)
+                async with self.session_pool() as session:
+                    digest = await orm_save_blob(session, image_out)
+                    await orm_update_image_job(session, job.id, result=digest)
+            else:
+                image_out = await get_blob(job.result)
+
+            if not job.delivered:
+                input_file = BufferedInputFile(file=image_out, filename="your_image.jpeg")
+                await self.bot.send_document(job.chat_id, input_file)
+                await self.bot.send_photo(job.chat_id, photo=input_file, caption='Ваше изображение😌',
+                                          reply_markup=image_buttons(job.id))
+                async with self.session_pool() as session:
+                    await orm_update_image_job(session, job.id, delivered=True)
+
+            async with self.session_pool() as session:
+                if not job.billed:
+                    # задачи, поставленные до списания при постановке, оплачиваются после доставки
+                    await orm_bill_image_job(session, job.id, rate[job.model])
+                await orm_update_image_job(session, job.id, status='done')
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(e)
+            await self._retry_or_fail(job, e)
+
+    async def _retry_or_fail(self, job, e: Exception):
+        retryable = e.retryable if isinstance(e, AIRequestError) else True
+        attempts = job.attempts + 1
+        async with self.session_pool() as session:
+            if retryable and attempts < IMAGE_JOB_MAX_ATTEMPTS:
+                delay = getattr(e, 'retry_after', None) or min(300, 10 * 2 ** attempts) * random.uniform(0.5, 1.5)
+                await orm_update_image_job(session, job.id, attempts=attempts,
+                                           next_run_at=datetime.now() + timedelta(seconds=delay))
+                return
+            await orm_update_image_job(session, job.id, attempts=attempts, status='failed')
+            if not job.delivered:
+                await orm_refund_image_job(session, job.id, rate[job.model])
+
+        if isinstance(e, AIRequestError):
+            text = MODERATION_TEXT if e.kind == 'moderation' else e.user_message
+        else:
+            text = ERROR_TEXT
+        try:
+            await self.bot.send_message(job.chat_id, text)
+        except Exception as e:
+            print(e)
+
+
+image_jobs = ImageJobWorker()
@@ -1,15 +1,35 @@
 import asyncio
 import base64
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from aiogram import Bot
-from aiogram.client.session import aiohttp
+from aiogram import Bot, types
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from PIL import Image, ImageOps
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from app.open_webapp_bot.AI.database.orm_query import orm_get_balance, orm_update_balance
+from app.open_webapp_bot.AI.api_requests.resilience import AIRequestError
+from app.open_webapp_bot.AI.api_requests.scheduler import scheduler
+from app.open_webapp_bot.AI.database.orm_query import orm_get_balance, orm_update_balance, orm_reserve_tokens
+from app.open_webapp_bot.AI.handlers.telegram_media import media_fetcher
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 
+# Потоковая выдача ответов текстовых моделей
+STREAM_RESPONSES = os.getenv('AI_STREAMING', '1') == '1'
+# Telegram не любит частые правки одного сообщения, поэтому правим не чаще раза в STREAM_EDIT_INTERVAL секунд
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', 1.5))
+MESS_MAX_LENGTH = 4096
+
+# Фото с телефона в 12+ Мп модели всё равно ужимают, поэтому сразу уменьшаем их
+# до IMAGE_MAX_SIDE по большей стороне: меньше base64 в запросе и быстрее загрузка
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 2048))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', 4 * 1024 * 1024))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 90))
+image_pool = ThreadPoolExecutor(max_workers=int(os.getenv('IMAGE_WORKERS', 4)), thread_name_prefix='image')
+
 permitted_gemini_docs = ['application/pdf', 'application/x-javascript', 'text/javascript',
                         'application/x-python', 'text/x-python', 'text/plain', 'text/html',
                         'text/css', 'text/md', 'text/csv', 'text/xml', 'text/rtf', 'video/mp4','video/mpeg','video/mov', 'video/avi', 'video/x-flv',
@@ -32,7 +52,6 @@ rate = {
 
 async def send_long_text(text):
     chunks = []
-    MESS_MAX_LENGTH = 4096
     start = 0
     text_length = len(text)
 
@@ -58,6 +77,95 @@ async def send_long_text(text):
 
     return chunks
 
+class StreamingMessage:
+    # Показывает ответ модели по мере генерации: первое сообщение отправляется сразу,
+    # дальше оно редактируется не чаще STREAM_EDIT_INTERVAL, после 4096 символов начинается новое.
+    # finalize преобразует готовый кусок перед отрисовкой в markdown (например, добавляет ссылки)
+    def __init__(self, message: types.Message, interval: float = STREAM_EDIT_INTERVAL, finalize=None):
+        self.message = message
+        self.interval = interval
+        self.finalize = finalize
+        self.text = ''
+        self.offset = 0
+        self.current: types.Message | None = None
+        self.shown = ''
+        self.next_edit = 0.0
+
+    @property
+    def delivered(self) -> bool:
+        # пользователь уже видит хотя бы часть ответа
+        return self.current is not None or self.offset > 0
+
+    async def feed(self, delta: str):
+        self.text += delta
+        if self.current is None or asyncio.get_running_loop().time() >= self.next_edit:
+            await self._flush()
+
+    async def finish(self) -> str:
+        await self._flush(final=True)
+        return self.text
+
+    async def _flush(self, final: bool = False):
+        while len(self.text) - self.offset > MESS_MAX_LENGTH:
+            part = self.text[self.offset:self.offset + MESS_MAX_LENGTH]
+            split_pos = max(part.rfind(' '), part.rfind('\n'))
+            if split_pos <= 0:
+                split_pos = MESS_MAX_LENGTH
+            await self._show(part[:split_pos], final=True)
+            self.offset += split_pos
+            self.current = None
+            self.shown = ''
+
+        await self._show(self.text[self.offset:], final)
+
+    async def _show(self, chunk: str, final: bool):
+        if not chunk.strip():
+            return
+        try:
+            if final:
+                await self._render(chunk)
+            elif self.current is None:
+                self.current = await self.message.answer(chunk, parse_mode=None)
+            elif chunk != self.shown:
+                await self.current.edit_text(chunk, parse_mode=None)
+            self.shown = chunk
+            self.next_edit = asyncio.get_running_loop().time() + self.interval
+        except TelegramRetryAfter as e:
+            self.next_edit = asyncio.get_running_loop().time() + e.retry_after
+            if not final:
+                return
+            await asyncio.sleep(e.retry_after)
+            return await self._show(chunk, final)
+        except TelegramBadRequest as e:
+            print(e)
+
+    async def _render(self, chunk: str):
+        # готовый кусок - одна правка в markdown, обычный текст только если Telegram её не принял
+        text = self.finalize(chunk) if self.finalize else chunk
+        try:
+            if self.current is None:
+                self.current = await self.message.answer(text, parse_mode=ParseMode.MARKDOWN)
+            else:
+                await self.current.edit_text(text, parse_mode=ParseMode.MARKDOWN)
+        except TelegramBadRequest as e:
+            print(e)
+            if self.current is None:
+                self.current = await self.message.answer(chunk, parse_mode=None)
+            elif chunk != self.shown:
+                await self.current.edit_text(chunk, parse_mode=None)
+
+
+async def send_streaming_text(message: types.Message, deltas, stop_typing: asyncio.Event = None,
+                              finalize=None, stream: StreamingMessage = None) -> str:
+    # stream можно передать свой, чтобы после ошибки узнать, успел ли пользователь что-то увидеть
+    stream = stream or StreamingMessage(message, finalize=finalize)
+    async for delta in deltas:
+        if stop_typing:
+            stop_typing.set()
+        await stream.feed(delta)
+    return await stream.finish()
+
+
 async def get_image_for_video(image: str):
 
     with open(image, 'rb') as img_file:
@@ -66,34 +174,44 @@ async def get_image_for_video(image: str):
     data_uri = f'data:{mime_type};base64,{b64_string}'
     return data_uri
 
-async def get_image_for_ai(bot: Bot, http_session: aiohttp.ClientSession, user_id: int, photo_id: str = None,  photo_bytes = None, ):
-    # files = []
+def prepare_image(data: bytes) -> str:
+    # Выполняется в пуле потоков: декодирование и ресайз больших фото блокируют надолго
+    try:
+        # Image.open читает только заголовок, поэтому маленькие фото не декодируются
+        with Image.open(io.BytesIO(data)) as img:
+            if len(data) > IMAGE_MAX_BYTES or max(img.size) > IMAGE_MAX_SIDE:
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+                buffer = io.BytesIO()
+                img.convert('RGB').save(buffer, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+                data = buffer.getvalue()
+    except Exception as e:
+        # не картинка или неизвестный формат - отдаём модели как есть
+        print(e)
+    return base64.b64encode(data).decode('utf-8')
+
+
+async def get_image_for_ai(bot: Bot, user_id: int, photo_id: str = None,  photo_bytes = None,
+                           photo_unique_id: str = None):
     if photo_id:
-        file_id = photo_id
-        file_info = await bot.get_file(file_id)
-        file_path = file_info.file_path
-
-        file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        async with http_session.get(file_url) as response:
-            if response.status != 200:
-                # Обработка ошибок HTTP
-                text = await response.text()
-                raise Exception(f"HTTP error {response.status}: {text}")
-            bytes = await response.content.read()
+        bytes = await media_fetcher.fetch(bot, photo_id, photo_unique_id)
     elif photo_bytes:
         bytes = photo_bytes
 
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(image_pool, prepare_image, bytes)
 
-    file = f"app/open_webapp_bot/AI/files/image_for_gpt{user_id}.jpeg"
+def error_message(e: Exception) -> str:
+    if isinstance(e, AIRequestError):
+        return e.user_message
+    return "Произошла ошибка при обработке запроса. Пожалуйста, повторите попытку\nЕсли ошибка продолжает возникать, дайте нам знать @aitb_support"
 
-    with open(file, "wb") as f:
-        f.write(bytes)
+def ai_slot(message: types.Message, user_id: int, model: str):
+    # Место в очереди к модели, если слота нет сразу - сообщаем пользователю его номер
+    async def notify(position: int):
+        await message.answer(f'⏳ Сейчас много запросов, вы #{position} в очереди. Ответ придёт автоматически')
 
-    with open(file, "rb") as f:
-        b64_image = base64.b64encode(f.read()).decode('utf-8')
-
-    os.remove(file)
-    return b64_image
+    return scheduler.slot(model, user_id, on_queued=notify)
 
 async def send_typing_action(bot: Bot, chat_id: int, stop_event: asyncio.Event, delay: float = 4.0):
     while not stop_event.is_set():
@@ -104,13 +222,27 @@ async def send_typing_action(bot: Bot, chat_id: int, stop_event: asyncio.Event,
         await asyncio.sleep(delay)
 
 async def check_balance(session: AsyncSession, user_id: int, model: str):
+    # Только проверка, без списания. Платные запросы к моделям списывают через reserve_tokens
     payment = rate[model]
     balance = await orm_get_balance(session, user_id)
-    if balance >= payment:
+    if balance is not None and balance >= payment:
         return True
     else:
         return False
 
+async def reserve_tokens(session: AsyncSession, user_id: int, model: str) -> bool:
+    # Списывает стоимость до запроса к модели, False - токенов не хватает.
+    # Если ответа пользователь не получил, токены возвращает refund_tokens
+    return await orm_reserve_tokens(session, user_id, rate[model]) is not None
+
+async def refund_tokens(session: AsyncSession, user_id: int, model: str):
+    try:
+        # после ошибки в обработчике транзакция сессии может быть сломана
+        await session.rollback()
+        await orm_update_balance(session, user_id, rate[model])
+    except Exception as e:
+        print(e)
+
 async def use_model(session: AsyncSession, user_id: int, model: str):
     payment = -rate[model]
     await orm_update_balance(session, user_id, payment)
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import Bot
+from aiogram.types import File
+
+# Ссылка на файл из get_file живёт не меньше часа, дальше её нужно запрашивать заново
+MEDIA_FILE_TTL = float(os.getenv('MEDIA_FILE_TTL', 50 * 60))
+MEDIA_FILE_ITEMS = int(os.getenv('MEDIA_FILE_ITEMS', 5000))
+MEDIA_BYTES_TTL = float(os.getenv('MEDIA_BYTES_TTL', 30 * 60))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 100 * 1024 * 1024))
+
+
+class TelegramMediaFetcher:
+    # Скачивает файлы из Telegram с кэшем по file_unique_id (он одинаков для всех ботов и не меняется,
+    # в отличие от file_id). Кэшируются и ответы get_file, и сами байты; одновременные запросы
+    # одного файла ждут одно скачивание.
+    def __init__(self, file_ttl: float = MEDIA_FILE_TTL, file_items: int = MEDIA_FILE_ITEMS,
+                 bytes_ttl: float = MEDIA_BYTES_TTL, max_bytes: int = MEDIA_MAX_BYTES):
+        self.file_ttl = file_ttl
+        self.file_items = file_items
+        self.bytes_ttl = bytes_ttl
+        self.max_bytes = max_bytes
+        self.files: OrderedDict[str, tuple[float, File]] = OrderedDict()
+        self.contents: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.size = 0
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.get_file_calls = 0
+
+    async def _get_file(self, bot: Bot, file_id: str, key: str) -> File:
+        item = self.files.get(key)
+        if item and item[0] > time.monotonic():
+            self.files.move_to_end(key)
+            return item[1]
+        self.get_file_calls += 1
+        file = await bot.get_file(file_id)
+        self.files[key] = (time.monotonic() + self.file_ttl, file)
+        self.files.move_to_end(key)
+        while len(self.files) > self.file_items:
+            self.files.popitem(last=False)
+        return file
+
+    def _get_bytes(self, key: str) -> bytes | None:
+        item = self.contents.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.monotonic():
+            self._drop(key)
+            return None
+        self.contents.move_to_end(key)
+        return item[1]
+
+    def _drop(self, key: str):
+        _, data = self.contents.pop(key)
+        self.size -= len(data)
+
+    def _put_bytes(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.contents:
+            self._drop(key)
+        self.contents[key] = (time.monotonic() + self.bytes_ttl, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.contents)))
+
+    async def _download(self, bot: Bot, file_id: str, key: str) -> bytes:
+        file = await self._get_file(bot, file_id, key)
+        buffer = await bot.download_file(file.file_path)
+        data = buffer.getvalue()
+        self._put_bytes(key, data)
+        return data
+
+    async def fetch(self, bot: Bot, file_id: str, file_unique_id: str = None) -> bytes:
+        key = file_unique_id or file_id
+        data = self._get_bytes(key)
+        if data is not None:
+            self.hits += 1
+            return data
+
+        future = self.inflight.get(key)
+        if future:
+            self.hits += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.ensure_future(self._download(bot, file_id, key))
+        self.inflight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.inflight.pop(key, None)
+            else:
+                # ожидающий отменён, но скачивание нужно остальным
+                future.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'get_file_calls': self.get_file_calls,
+            'items': len(self.contents),
+            'bytes': self.size,
+        }
+
+
+media_fetcher = TelegramMediaFetcher()
@@ -8,7 +8,7 @@ from aiogram.types import LabeledPrice, PreCheckoutQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.open_webapp_bot.AI.database.orm_query import orm_get_balance, orm_update_balance, orm_get_promo_code, \
-    orm_delete_promo_code, orm_use_promo_code
+    orm_delete_promo_code, orm_redeem_promo_code
 from app.open_webapp_bot.AI.kbds.inline import get_callback_btns, kbd_tk
 
 user_processes_ai = Router()
@@ -129,9 +129,7 @@ async def get_promo_code(message: types.Message, session: AsyncSession, state: F
             await state.clear()
             await orm_delete_promo_code(session, code.code)
             return
-        if user_id not in code.used_by:
-            await orm_use_promo_code(session, code.code, user_id)
-            await orm_update_balance(session, user_id, code.value)
+        if await orm_redeem_promo_code(session, code.code, user_id, code.value):
             await message.answer(f'Промокод активирован! Вам начислено {code.value} токенов')
         else:
             await message.answer('Вы уже использовали этот промокод')
@@ -0,0 +1,122 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiogram import Bot
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+
+from app.open_webapp_bot.AI.api_requests.resilience import AIRequestError
+from app.open_webapp_bot.AI.api_requests.video import veo_text_to_video, veo_get_generation
+from app.open_webapp_bot.AI.database.orm_query import orm_add_video_generation, orm_claim_video_generations, \
+    orm_update_video_generation
+from app.open_webapp_bot.AI.handlers.processing import reserve_tokens, refund_tokens
+
+# Генерации живут в таблице video_generation, поэтому переживают перезапуск бота.
+# Один фоновый цикл раз в VIDEO_TICK секунд забирает пачку генераций, которые пора проверить,
+# и опрашивает их параллельно. Интервал опроса растёт с каждой попыткой:
+# короткие видео забираются быстро, а долгие не нагружают API.
+# Стоимость списывается при создании генерации и возвращается, если видео так и не получилось.
+VIDEO_TICK = float(os.getenv('VIDEO_TICK', 2))
+VIDEO_BATCH = int(os.getenv('VIDEO_BATCH', 20))
+VIDEO_POLL_FIRST = float(os.getenv('VIDEO_POLL_FIRST', 20))
+VIDEO_POLL_MAX = float(os.getenv('VIDEO_POLL_MAX', 60))
+VIDEO_POLL_FACTOR = float(os.getenv('VIDEO_POLL_FACTOR', 1.5))
+# сколько опросов ждём, прежде чем считать генерацию потерянной (~30 минут при настройках по умолчанию)
+VIDEO_MAX_ATTEMPTS = int(os.getenv('VIDEO_MAX_ATTEMPTS', 40))
+# на это время генерация закрепляется за процессом, который её опрашивает
+VIDEO_LEASE = float(os.getenv('VIDEO_LEASE', 120))
+
+
+def poll_interval(attempts: int) -> float:
+    return min(VIDEO_POLL_MAX, VIDEO_POLL_FIRST * VIDEO_POLL_FACTOR ** attempts)
+
+
+class VideoTracker:
+    def __init__(self):
+        self.bot: Bot | None = None
+        self.http_session: aiohttp.ClientSession | None = None
+        self.session_pool: async_sessionmaker | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start_generation(self, session: AsyncSession, user_id: int, chat_id: int, model: str,
+                               prompt: str, ratio: str, image=None, long: bool | None = None) -> str | None:
+        """Списывает стоимость, создаёт генерацию и ставит её на опрос, None - у пользователя не хватает токенов.
+        Видео придёт пользователю отдельным сообщением"""
+        if not await reserve_tokens(session, user_id, model):
+            return None
+        try:
+            generation_id = await veo_text_to_video(self.http_session, prompt, ratio, image, long)
+        except Exception:
+            await refund_tokens(session, user_id, model)
+            raise
+        await orm_add_video_generation(session, generation_id, user_id, chat_id, model, VIDEO_POLL_FIRST)
+        return generation_id
+
+    def start(self, bot: Bot, http_session: aiohttp.ClientSession, session_pool: async_sessionmaker):
+        self.bot = bot
+        self.http_session = http_session
+        self.session_pool = session_pool
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.session_pool() as session:
+                    generations = await orm_claim_video_generations(session, VIDEO_BATCH, VIDEO_LEASE)
+                await asyncio.gather(*(self._poll(generation) for generation in generations))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(e)
+                generations = []
+            # если пачка заполнена целиком, в очереди могут быть ещё готовые к опросу генерации
+            if len(generations) < VIDEO_BATCH:
+                await asyncio.sleep(VIDEO_TICK)
+
+    async def _poll(self, generation):
+        try:
+            status, video_url = await veo_get_generation(self.http_session, generation.generation_id)
+        except AIRequestError as e:
+            # временная ошибка API: просто опросим позже
+            print(e)
+            status, video_url = 'pending', None
+
+        async with self.session_pool() as session:
+            if status == 'completed' and video_url:
+                await orm_update_video_generation(session, generation.generation_id, status='completed',
+                                                  video_url=video_url)
+                await self._deliver(generation.chat_id, video_url)
+            elif status == 'pending' and generation.attempts + 1 < VIDEO_MAX_ATTEMPTS:
+                await orm_update_video_generation(
+                    session, generation.generation_id, attempts=generation.attempts + 1,
+                    next_poll_at=datetime.now() + timedelta(seconds=poll_interval(generation.attempts + 1)))
+            else:
+                await orm_update_video_generation(session, generation.generation_id, status='failed')
+                await refund_tokens(session, generation.user_id, generation.model)
+                await self._notify_failed(generation.chat_id)
+
+    async def _deliver(self, chat_id: int, video_url: str):
+        try:
+            await self.bot.send_video(chat_id, video=video_url, caption='Ваше видео😌')
+        except Exception as e:
+            print(e)
+
+    async def _notify_failed(self, chat_id: int):
+        try:
+            await self.bot.send_message(chat_id, 'Не удалось сгенерировать видео, токены возвращены. Попробуйте еще раз😔')
+        except Exception as e:
+            print(e)
+
+
+video_tracker = VideoTracker()
@@ -1,3 +1,5 @@
+import os
+
 from aiogram.types import KeyboardButton, ReplyKeyboardRemove
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
@@ -19,9 +21,13 @@ def get_keyboard(
     )
 del_kbd = ReplyKeyboardRemove()
 
+# генерация видео включается отдельно: она самая дорогая и зависит от внешнего API
+VIDEO_ENABLED = os.getenv('VIDEO_ENABLED', '0') == '1'
+
 main_kbd = get_keyboard('📝 Текст',
                        '🖼️ Изображения',
                        '👨‍🍳 Рецепты по фото',
+                       *(['🎬 Видео'] if VIDEO_ENABLED else []),
                        '💲 Баланс',
                        '🤖❗️GPT 5❗️🤖',
                        placeholder='Выберите режим',
@@ -10,10 +10,16 @@ import asyncio
 import os
 from dotenv import load_dotenv
 
-from app.open_webapp_bot.AI.database.engine import session_maker, create_db
+from app.open_webapp_bot.AI.api_requests.client import close_client
+from app.open_webapp_bot.AI.database.engine import session_maker, handler_session_maker, create_db
+from app.open_webapp_bot.AI.database.fsm_storage import SQLAlchemyStorage
 from app.open_webapp_bot.AI.handlers.user_processes import user_processes_ai
 from app.open_webapp_bot.AI.handlers.admin_handlers import admin_router
+from app.open_webapp_bot.AI.handlers.image_jobs import image_jobs
+from app.open_webapp_bot.AI.handlers.video_tracker import video_tracker
 from app.open_webapp_bot.AI.middlewares.db import DataBaseSession, HTTPSessionMiddleware
+from app.shared.chat_order import ChatOrderMiddleware, ChatOrderedRunner
+from app.shared.webhook import run_webhook
 from app.shared.yookassa_api import create_payment_link
 
 from app.open_webapp_bot.AI.handlers.AI_func import ai_func
@@ -24,8 +30,18 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBAPP_URL = os.getenv("WEBAPP_URL")
 
+# db - состояния в Postgres (общие для всех процессов бота), memory - в памяти процесса
+FSM_STORAGE = os.getenv("FSM_STORAGE", "db")
+# polling или webhook; для вебхука нужен публичный HTTPS адрес WEBHOOK_URL, проксируемый на WEBHOOK_HOST:WEBHOOK_PORT
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8081))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=SQLAlchemyStorage(session_maker) if FSM_STORAGE == "db" else MemoryStorage())
 
 dp.include_router(admin_router)
 dp.include_router(user_processes_ai)
@@ -92,6 +108,7 @@ async def on_startup(bot):
 async def on_shutdown(bot):
     print('bot has fallen')
     await http_session.close()
+    await close_client()
 
 async def main():
 
@@ -100,12 +117,25 @@ async def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
-    dp.update.middleware(DataBaseSession(session_pool=session_maker))
+    dp.update.middleware(DataBaseSession(session_pool=handler_session_maker))
     http_client_session = await http_session.create_session()
     dp.update.middleware(HTTPSessionMiddleware(http_client_session))
+    # незавершённые генерации видео из базы подхватываются сразу после запуска
+    video_tracker.start(bot, http_client_session, session_maker)
+    image_jobs.start(bot, session_maker)
     await bot.set_my_commands(commands=[BotCommand(command='start', description='🔙 В главное меню')], scope=BotCommandScopeAllPrivateChats())
 
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET)
+        else:
+            await bot.delete_webhook()
+            # в режиме вебхука порядок апдейтов внутри чата соблюдает UpdateWorkerPool
+            dp.update.outer_middleware(ChatOrderMiddleware(ChatOrderedRunner()))
+            await dp.start_polling(bot)
+    finally:
+        await video_tracker.stop()
+        await image_jobs.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,152 @@
+import asyncio
+import os
+from collections import deque
+from contextvars import ContextVar, copy_context
+from typing import Any, Awaitable, Callable, Hashable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+# Апдейты одного чата обрабатываются строго по очереди, разные чаты - параллельно.
+# CHAT_MAX_ACTIVE - сколько обработчиков работает одновременно, CHAT_QUEUE_SIZE - сколько апдейтов
+# может ждать своей очереди в одном чате, CHAT_MAX_PENDING - во всех чатах вместе.
+CHAT_MAX_ACTIVE = int(os.getenv('CHAT_MAX_ACTIVE', 64))
+CHAT_QUEUE_SIZE = int(os.getenv('CHAT_QUEUE_SIZE', 20))
+CHAT_MAX_PENDING = int(os.getenv('CHAT_MAX_PENDING', 5000))
+
+
+class ChatTurn:
+    def __init__(self):
+        self.released = asyncio.Event()
+
+
+current_turn: ContextVar[ChatTurn | None] = ContextVar('current_turn', default=None)
+
+
+def release_chat():
+    """Отпускает очередь чата из долгого обработчика: дальше он выполняется в фоне,
+    а следующие апдейты чата (например, «🔙 Назад») обрабатываются сразу"""
+    turn = current_turn.get()
+    if turn:
+        turn.released.set()
+
+
+class ChatOrderedRunner:
+    def __init__(self, max_active: int = CHAT_MAX_ACTIVE, queue_size: int = CHAT_QUEUE_SIZE,
+                 max_pending: int = CHAT_MAX_PENDING):
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+        self.semaphore = asyncio.Semaphore(max_active)
+        self.chats: dict[Hashable, deque] = {}
+        self.drains: set[asyncio.Task] = set()
+        self.background: set[asyncio.Task] = set()
+        self.pending = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable[Any]]) -> bool:
+        """Ставит job в очередь чата key. False - очередь чата или общий лимит переполнены"""
+        queue = self.chats.get(key)
+        if self.pending >= self.max_pending or (queue is not None and len(queue) >= self.queue_size):
+            self.rejected += 1
+            return False
+        if queue is None:
+            queue = self.chats[key] = deque()
+            task = asyncio.create_task(self._drain(key, queue))
+            self.drains.add(task)
+            task.add_done_callback(self.drains.discard)
+        # контекст отправителя, чтобы contextvars апдейта были видны в обработчике
+        queue.append((job, copy_context()))
+        self.pending += 1
+        return True
+
+    async def run(self, key: Hashable, job: Callable[[], Awaitable[Any]]) -> Any:
+        """Как submit, но дожидается результата job. QueueFull - очередь переполнена"""
+        future = asyncio.get_running_loop().create_future()
+
+        async def wrapped():
+            try:
+                future.set_result(await job())
+            except Exception as e:
+                future.set_exception(e)
+                raise
+
+        if not self.submit(key, wrapped):
+            raise asyncio.QueueFull
+        return await future
+
+    async def _run_job(self, job, turn: ChatTurn):
+        current_turn.set(turn)
+        try:
+            await job()
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            print(e)
+        finally:
+            turn.released.set()
+
+    async def _drain(self, key: Hashable, queue: deque):
+        try:
+            while queue:
+                job, context = queue.popleft()
+                self.pending -= 1
+                turn = ChatTurn()
+                async with self.semaphore:
+                    task = context.run(asyncio.create_task, self._run_job(job, turn))
+                    await turn.released.wait()
+                if not task.done():
+                    # обработчик отпустил очередь и доработает в фоне
+                    self.background.add(task)
+                    task.add_done_callback(self.background.discard)
+        finally:
+            self.chats.pop(key, None)
+
+    async def join(self, timeout: float | None = None):
+        """Ждёт, пока будут обработаны все принятые апдейты, включая фоновые хвосты обработчиков"""
+        async def wait_all():
+            while self.drains or self.background:
+                await asyncio.gather(*self.drains, *self.background, return_exceptions=True)
+
+        try:
+            await asyncio.wait_for(wait_all(), timeout)
+        except asyncio.TimeoutError:
+            print('не все апдейты обработаны до остановки')
+            for task in [*self.drains, *self.background]:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'chats': len(self.chats),
+            'queued': self.pending,
+            'background': len(self.background),
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+
+def event_chat_key(data: dict, update_id: int) -> Hashable:
+    chat = data.get('event_chat')
+    if chat:
+        return chat.id
+    user = data.get('event_from_user')
+    if user:
+        return user.id
+    return update_id
+
+
+class ChatOrderMiddleware(BaseMiddleware):
+    # Внешний middleware апдейтов для режима polling, регистрируется после стандартных
+    # middleware диспетчера, чтобы в data уже были event_chat и event_from_user
+    def __init__(self, runner: ChatOrderedRunner):
+        self.runner = runner
+
+    async def __call__(self, handler, event, data):
+        key = event_chat_key(data, event.update_id)
+        try:
+            return await self.runner.run(key, lambda: handler(event, data))
+        except asyncio.QueueFull:
+            print(f'очередь чата {key} переполнена, апдейт {event.update_id} пропущен')
+            return UNHANDLED
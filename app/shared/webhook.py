@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+
+from app.shared.chat_order import ChatOrderedRunner
+
+# Приём обновлений через вебхук: HTTP-обработчик только кладёт апдейт в очередь его чата и сразу
+# отвечает Telegram. Апдейты одного чата обрабатываются строго по порядку, разных - параллельно,
+# не более WEBHOOK_WORKERS одновременно (см. chat_order.py).
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 16))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 30))
+
+
+def update_chat_id(data: dict) -> int | None:
+    # chat.id из любого типа апдейта (message, callback_query.message, my_chat_member...), иначе id пользователя
+    for field, value in data.items():
+        if field == 'update_id' or not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat:
+            return chat.get('id')
+        user = value.get('from') or value.get('user')
+        if user:
+            return user.get('id')
+    return None
+
+
+class UpdateWorkerPool:
+    def __init__(self, bot: Bot, dp: Dispatcher, workers: int = WEBHOOK_WORKERS,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, **kwargs):
+        self.bot = bot
+        self.dp = dp
+        self.kwargs = kwargs
+        self.runner = ChatOrderedRunner(max_active=workers, max_pending=queue_size)
+
+    def submit(self, data: dict) -> bool:
+        """Кладёт апдейт в очередь его чата. False - очередь переполнена"""
+        key = update_chat_id(data)
+        if key is None:
+            key = data.get('update_id', 0)
+        return self.runner.submit(key, lambda: self._process(data))
+
+    async def _process(self, data: dict):
+        update = Update.model_validate(data, context={'bot': self.bot})
+        result = await self.dp.feed_update(self.bot, update, **self.kwargs)
+        if isinstance(result, TelegramMethod):
+            await self.dp.silent_call_request(self.bot, result)
+
+    async def stop(self):
+        # даём доработать тому, что уже принято от Telegram
+        await self.runner.join(WEBHOOK_DRAIN_TIMEOUT)
+
+    def stats(self) -> dict:
+        return self.runner.stats()
+
+
+def create_webhook_app(pool: UpdateWorkerPool, path: str, secret: str | None = None) -> web.Application:
+    async def receive(request: web.Request) -> web.Response:
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except (json.JSONDecodeError, ValueError):
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        if not pool.submit(data):
+            # Telegram повторит доставку позже
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, url: str, path: str, host: str, port: int,
+                      secret: str | None = None, **kwargs):
+    """Аналог dp.start_polling для режима вебхука: работает, пока задачу не отменят"""
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data, **kwargs}
+    workflow_data.pop('bot', None)
+    await dp.emit_startup(bot=bot, **workflow_data)
+
+    pool = UpdateWorkerPool(bot, dp, **kwargs)
+    runner = web.AppRunner(create_webhook_app(pool, path, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    await bot.set_webhook(f'{url.rstrip("/")}{path}', secret_token=secret,
+                          allowed_updates=dp.resolve_used_update_types(), max_connections=100)
+    print(f'Вебхук слушает {host}:{port}{path}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
+        await dp.emit_shutdown(bot=bot, **workflow_data)
@@ -0,0 +1,167 @@
+"""Нагрузочный прогон вебхука записанными апдейтами.
+
+    python -m app.shared.webhook_load_test updates.jsonl --url http://127.0.0.1:8081/telegram/webhook
+    python -m app.shared.webhook_load_test updates.jsonl --local --handler-delay 0.2
+
+updates.jsonl - по одному JSON апдейта Telegram в строке. Каждый апдейт отправляется --repeat раз,
+--chats размножает чаты (к chat.id и from.id добавляется номер копии), update_id перенумеровываются.
+С --local поднимается собственный приёмник с пустым диспетчером, который ждёт --handler-delay секунд
+на апдейт и проверяет, что апдейты каждого чата обработаны в порядке приёма.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from app.shared.webhook import UpdateWorkerPool, create_webhook_app, update_chat_id
+
+
+def load_updates(path: str) -> list[dict]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def shift_ids(value, offset: int):
+    # одинаковый сдвиг для chat.id и from.id, чтобы копия выглядела отдельным пользователем
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ('chat', 'from', 'user') and isinstance(item, dict) and isinstance(item.get('id'), int):
+                item['id'] += offset
+            else:
+                shift_ids(item, offset)
+    elif isinstance(value, list):
+        for item in value:
+            shift_ids(item, offset)
+
+
+def build_stream(updates: list[dict], repeat: int, chats: int) -> list[dict]:
+    stream = []
+    update_id = 1
+    for _ in range(repeat):
+        for update in updates:
+            for copy_number in range(chats):
+                data = copy.deepcopy(update)
+                shift_ids(data, copy_number * 1_000_000_000)
+                data['update_id'] = update_id
+                update_id += 1
+                stream.append(data)
+    return stream
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def replay(url: str, stream: list[dict], concurrency: int, secret: str | None) -> dict:
+    latencies = []
+    statuses = {}
+    queue = asyncio.Queue()
+    for data in stream:
+        queue.put_nowait(data)
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+
+    async with aiohttp.ClientSession() as session:
+        async def sender():
+            while not queue.empty():
+                data = queue.get_nowait()
+                start = time.perf_counter()
+                async with session.post(url, json=data, headers=headers) as response:
+                    await response.read()
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'updates': len(stream),
+        'seconds': elapsed,
+        'rps': len(stream) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'statuses': statuses,
+    }
+
+
+async def run_local(args, stream: list[dict]):
+    # Токен в формате Telegram, запросы к API не выполняются
+    bot = Bot(token='42:local-load-test')
+    dp = Dispatcher()
+    arrived: dict[int, list[int]] = {}
+    chat_of: dict[int, int] = {}
+    seen: dict[int, list[int]] = {}
+
+    @dp.update.outer_middleware()
+    async def record(handler, event: Update, data):
+        await asyncio.sleep(args.handler_delay)
+        seen.setdefault(chat_of[event.update_id], []).append(event.update_id)
+
+    pool = UpdateWorkerPool(bot, dp, workers=args.workers, queue_size=args.queue_size)
+    submit = pool.submit
+
+    def submit_and_record(data: dict) -> bool:
+        # порядок проверяем относительно порядка приёма: отправители работают параллельно
+        accepted = submit(data)
+        if accepted:
+            chat_of[data['update_id']] = update_chat_id(data)
+            arrived.setdefault(chat_of[data['update_id']], []).append(data['update_id'])
+        return accepted
+
+    pool.submit = submit_and_record
+    runner = web.AppRunner(create_webhook_app(pool, '/webhook'))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+    try:
+        result = await replay(f'http://127.0.0.1:{args.port}/webhook', stream, args.concurrency, None)
+        start = time.perf_counter()
+        await pool.stop()
+        result['drain_seconds'] = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
+    stats = pool.stats()
+    result['processed'] = stats['processed']
+    result['rejected'] = stats['rejected']
+    result['failed'] = stats['failed']
+    result['out_of_order_chats'] = sum(1 for chat_id, ids in arrived.items() if seen.get(chat_id) != ids)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('updates')
+    parser.add_argument('--url', default='http://127.0.0.1:8081/telegram/webhook')
+    parser.add_argument('--secret')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--chats', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--local', action='store_true')
+    parser.add_argument('--handler-delay', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--queue-size', type=int, default=100_000)
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args()
+
+    stream = build_stream(load_updates(args.updates), args.repeat, args.chats)
+    if args.local:
+        result = asyncio.run(run_local(args, stream))
+    else:
+        result = asyncio.run(replay(args.url, stream, args.concurrency, args.secret))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()